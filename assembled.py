@@ -0,0 +1,80 @@
+"""
+assembled.py
+
+Module containing the definitions of the sheets of the assembled workbook
+(see generate-assembled-data.py), kept in an importable module so that
+they can be passed to worker processes.
+"""
+
+import columnar # Module local to this project.
+import sheets # Module local to this project.
+
+def sheet_buses(file_buses_json):
+    columns = [
+        ('Bus Capacity', lambda b: int(b['Bus Capacity'])),
+        ('Bus ID', lambda b: b['Bus ID']),
+        ('Bus Longitude', lambda b: float(b['Bus Longitude'])),
+        ('Bus Latitude', lambda b: float(b['Bus Latitude'])),
+        ('Bus Type', lambda b: b['Bus Type']),
+        ('Bus Yard', lambda b: b['Bus Yard']),
+        ('Bus Yard Address', lambda b: b['Bus Yard Address'])
+      ]
+    buses = columnar.read_records(file_buses_json)
+    return ("Buses", columns, buses, "Converting JSON bus entries to XLSX rows (Buses)")
+
+def sheet_assignments(students):
+    '''
+    The student stop assignments sheet, given the student data file or any
+    iterator over the student features. The stop and bus assignments are
+    read from the side tables of the student data file, which must exist
+    and be up to date.
+    '''
+    columns = [
+        ('Student Longitude', lambda f: float(f['geometry']['coordinates'][0][0])),
+        ('Student Latitude', lambda f: float(f['geometry']['coordinates'][0][1])),
+        ('Pickup Type', lambda f: f['properties'].get('pickup')),
+        #('Grade', lambda f: f['properties'].get('grade')),
+        ('Maximum Walk Distance', lambda f: f['properties'].get('walk')),
+        #('Current School Start Time', lambda f: f['properties'].get('school_start')),
+        #('Current School End Time', lambda f: f['properties'].get('school_end')),
+        ('School Longitude', lambda f: float(f['geometry']['coordinates'][-1][0])),
+        ('School Latitude', lambda f: float(f['geometry']['coordinates'][-1][1])),
+        ('Bus ID', lambda f: f['properties'].get('bus_id')),
+        ('Stop Longitude', lambda f: float(f['geometry']['coordinates'][1][0])),
+        ('Stop Latitude', lambda f: float(f['geometry']['coordinates'][1][1]))
+      ]
+    features = columnar.iter_features(students, sides=['stops', 'buses']) if isinstance(students, str) else students
+    return ("Stop-Assignments", columns, features, "Converting GeoJSON features to XLSX rows (Stop-Assignments)")
+
+def sheet_routes(routes):
+    '''
+    The routes sheet (with one row for every waypoint of every route),
+    given the route data file or any iterator over the route features.
+    '''
+    columns = [
+        ('Bus ID', lambda e: e[2]),
+        ('Waypoint Longitude', lambda e: e[0]),
+        ('Waypoint Latitude', lambda e: e[1])
+        #('Waypoint Address', lambda e: e[3])
+      ]
+    features = columnar.iter_features(routes, sides=[]) if isinstance(routes, str) else routes
+    entries = ((p[0], p[1], f['properties']['bus_id'], '?') for f in features for p in f['geometry']['coordinates'])
+    return ("Routes", columns, entries, "Converting GeoJSON coordinates to XLSX rows (Routes)")
+
+def sheet_spool(sheet, source, file_spool):
+    '''
+    Compute the rows of a sheet (given its function and source) and spool
+    them to a file in chunks, returning the sheet name, the headers, and
+    the file.
+    '''
+    (name, columns, items, _) = sheet(source)
+    return (name, [header for (header, function) in columns], sheets.spool_rows(file_spool, columns, items))
+
+def sheet_part(sheet, source, file_part):
+    '''
+    Write a sheet (given its function and source) to its own file.
+    '''
+    (name, columns, items, _) = sheet(source)
+    return sheets.write_part(file_part, name, columns, items)
+
+## eof
@@ -0,0 +1,56 @@
+"""
+benchmarks/graph-engines.py
+
+Compares the networkx and CSR graph engines of Grid on the prepared Boston
+segments: memory held by the whole grid and by the graph alone, path query
+throughput, and whether both engines produce identical paths.
+"""
+
+import os
+import sys
+import time
+import random
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from grid import Grid # Module local to this project.
+from graph import GraphCSR # Module local to this project.
+
+if __name__ == "__main__":
+    grids = {}
+    for engine in ['networkx', 'csr']:
+        tracemalloc.start()
+        grids[engine] = Grid('input/segments-prepared.geojson', engine=engine)
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%-9s grid memory %8.1f MB' % (engine, current / 2**20))
+
+    def graph_csr(arrays):
+        graph = GraphCSR(arrays['nodes'], arrays['edges'], arrays['edges_distance'], grids['csr'].node_to_id)
+        graph._adjacency() # Built by the first search.
+        return graph
+
+    arrays = grids['csr'].arrays
+    builders = [('networkx', lambda: Grid.arrays_networkx(arrays)), ('csr', lambda: graph_csr(arrays))]
+    for (engine, build) in builders:
+        tracemalloc.start()
+        graph = build()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('%-9s graph memory %7.1f MB' % (engine, current / 2**20))
+        del graph
+
+    random.seed(0)
+    nodes = [tuple(c) for c in grids['csr'].nodes[grids['csr'].intersections].tolist()]
+    pairs = [(random.choice(nodes), random.choice(nodes)) for _ in range(1000)]
+
+    paths = {}
+    for (engine, grid) in grids.items():
+        start = time.perf_counter()
+        paths[engine] = [grid.shortest_path(s, t) if grid.has_path(s, t) else None for (s, t) in pairs]
+        elapsed = time.perf_counter() - start
+        print('%-9s %8.1f path queries/s' % (engine, len(pairs) / elapsed))
+
+    print('identical paths: ' + str(paths['networkx'] == paths['csr']))
+
+## eof
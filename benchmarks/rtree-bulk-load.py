@@ -0,0 +1,63 @@
+"""
+benchmarks/rtree-bulk-load.py
+
+Compares building the segment R-trees by inserting one entry at a time
+against bulk (STR) loading, measuring construction time and the latency of
+nearest and intersection queries on the prepared Boston segments.
+"""
+
+import os
+import sys
+import time
+import random
+import numpy as np
+import rtree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from grid import Grid, rtree_from_bounds # Module local to this project.
+
+def rtree_incremental(bounds, ids):
+    tree = rtree.index.Index()
+    for (i, b) in zip(ids.tolist(), bounds.tolist()):
+        tree.insert(i, b)
+    return tree
+
+def timed(f, repeat = 3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (best, result)
+
+def queries(tree, boxes):
+    for b in boxes:
+        next(tree.nearest(b, 1), None)
+    for b in boxes:
+        list(tree.intersection(b))
+
+if __name__ == "__main__":
+    grid = Grid('input/segments-prepared.geojson')
+    points = grid.nodes[grid.arrays['points']]
+    datasets = [
+        ('nodes', np.hstack([points, points]), grid.arrays['points_index']),
+        ('edges', grid.arrays['segments_bounds'], grid.arrays['segments_index'])
+      ]
+
+    # Query boxes of roughly a city block around random locations in the grid.
+    random.seed(0)
+    (lo, hi) = (grid.nodes.min(axis=0), grid.nodes.max(axis=0))
+    boxes = []
+    for _ in range(10000):
+        (x, y) = (random.uniform(lo[0], hi[0]), random.uniform(lo[1], hi[1]))
+        boxes.append((x - 0.001, y - 0.001, x + 0.001, y + 0.001))
+
+    for (name, bounds, ids) in datasets:
+        print(name + ' (' + str(len(bounds)) + ' entries)')
+        for (method, build) in [('incremental', rtree_incremental), ('bulk', rtree_from_bounds)]:
+            (t_build, tree) = timed(lambda: build(bounds, ids))
+            (t_query, _) = timed(lambda: queries(tree, boxes))
+            print('  %-12s build %8.3fs   %8.1fus/query' % (method, t_build, 1e6 * t_query / (2 * len(boxes))))
+
+## eof
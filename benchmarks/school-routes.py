@@ -0,0 +1,55 @@
+"""
+benchmarks/school-routes.py
+
+Compares routing the stops of one school hop by hop (a straight-line choice
+of the next stop and a separate A* search for each hop) with the batched
+mode of generate-route-data.py (the next stop chosen by network distance,
+using one radius-limited Dijkstra search per hop), on random intersections
+of a prepared segments file, reporting the time taken and the number of
+Dijkstra searches per stop.
+"""
+
+import os
+import sys
+import time
+import random
+import importlib.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from grid import Grid # Module local to this project.
+from graph import GraphCSR # Module local to this project.
+
+def module(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules[spec.name])
+    return sys.modules[spec.name]
+
+searches = [0]
+dijkstra = GraphCSR.dijkstra
+def dijkstra_counted(self, *args, **kwargs):
+    searches[0] += 1
+    return dijkstra(self, *args, **kwargs)
+GraphCSR.dijkstra = dijkstra_counted
+
+if __name__ == "__main__":
+    file_segments = sys.argv[1] if len(sys.argv) > 1 else 'input/segments-prepared.geojson'
+    routes = module('generate-route-data')
+    for contract in [False, True]:
+        grid = Grid(file_segments, engine='csr', contract=contract)
+        largest = max(set(grid.components.tolist()), key=grid.components.tolist().count)
+        nodes = [tuple(c) for c in grid.nodes[grid.intersections[grid.components[grid.intersections] == largest]].tolist()]
+        random.seed(0)
+        buses = [{'Bus ID': 'B' + str(i), 'Bus Longitude': c[0], 'Bus Latitude': c[1], 'Bus Capacity': 72} for (i, c) in enumerate(random.sample(nodes, 200))]
+        for count in [60, 300, 1000]:
+            stops = list(dict((c, random.randint(1, 5)) for c in random.sample(nodes, min(count, len(nodes) - 1))).items())
+            school = random.choice(nodes)
+            for batched in [False, True]:
+                searches[0] = 0
+                start = time.perf_counter()
+                routes.school_routes(grid, school, stops, buses, 0, 20, 30, 'distance', batched)
+                elapsed = time.perf_counter() - start
+                print('%-10s %-9s %5d stops %8.2f s %6.2f searches/stop' % ('contracted' if contract else 'full', 'batched' if batched else 'hop', len(stops), elapsed, searches[0] / len(stops)))
+
+## eof
@@ -0,0 +1,56 @@
+"""
+benchmarks/students-scale.py
+
+Generates scaled-up synthetic student populations (as used for load-testing
+the routing tools) with and without streaming output, reporting throughput
+and the peak memory (resident set size) of each run, which is made in a
+separate process.
+"""
+
+import os
+import sys
+import time
+import resource
+import importlib.util
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from grid import Grid # Module local to this project.
+
+def module(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules[spec.name])
+    return sys.modules[spec.name]
+
+def run(scale, stream):
+    students = module('generate-student-data')
+    grid = Grid('input/segments-prepared.geojson')
+    start = time.perf_counter()
+    result = students.students_simulate(
+        grid,
+        'input/schools.csv',
+        'input/properties-by-zipcode.json',
+        'input/neighborhood-safety.json',
+        'input/grade-safe-distance.json',
+        'input/student-zip-school-percentages.json',
+        'output/students-scale.geojson',
+        kernel='vincenty', seed=1, workers=os.cpu_count(),
+        scale=scale, jitter_miles=0.1, stream=stream
+      )
+    elapsed = time.perf_counter() - start
+    count = result if stream else len(result['features'])
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    print('scale %3d  stream %-5s %9d students %8.0f students/s  peak memory %8.1f MB' % (scale, stream, count, count / elapsed, peak))
+
+if __name__ == "__main__":
+    scales = [int(s) for s in sys.argv[1:]] or [1, 10]
+    for scale in scales:
+        for stream in [False, True]:
+            process = multiprocessing.Process(target=run, args=(scale, stream))
+            process.start()
+            process.join()
+    os.remove('output/students-scale.geojson')
+
+## eof
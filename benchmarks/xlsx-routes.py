@@ -0,0 +1,83 @@
+"""
+benchmarks/xlsx-routes.py
+
+Regression benchmark for the Routes sheet of the assembled workbook (which
+has one row per waypoint, making it the largest sheet). Compares writing
+it cell by cell in xlsxwriter's default (in-memory) mode with the export
+path used by generate-assembled-data.py, on a synthetic route data set,
+reporting throughput and the peak memory (resident set size) of each run,
+which is made in a separate process.
+"""
+
+import os
+import sys
+import time
+import random
+import resource
+import tempfile
+import importlib.util
+import multiprocessing
+import geojson
+import xlsxwriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def module(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', name + '.py')
+    spec = importlib.util.spec_from_file_location(name.replace('-', '_'), path)
+    sys.modules[spec.name] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules[spec.name])
+    return sys.modules[spec.name]
+
+def routes_synthetic(file_routes, count, waypoints):
+    random.seed(0)
+    features = []
+    for i in range(count):
+        (lon, lat) = (random.uniform(-71.17, -70.99), random.uniform(42.23, 42.39))
+        coordinates = [(round(lon + 0.001 * k, 6), round(lat + 0.001 * random.randint(-5, 5), 6)) for k in range(waypoints)]
+        features.append(geojson.Feature(geometry=geojson.LineString(coordinates), properties={'bus_id': 'B' + str(i), 'load': 0}))
+    open(file_routes, 'w').write(geojson.dumps(geojson.FeatureCollection(features)))
+    return count * waypoints
+
+def cell_by_cell(file_routes, file_xlsx):
+    xl_workbook = xlsxwriter.Workbook(file_xlsx)
+    xl_bold = xl_workbook.add_format({'bold': True})
+    xl_sheet = xl_workbook.add_worksheet("Routes")
+    columns = [('Bus ID', lambda e: e[2]), ('Waypoint Longitude', lambda e: e[0]), ('Waypoint Latitude', lambda e: e[1])]
+    rs = geojson.load(open(file_routes, 'r'))
+    entries = [[p[0], p[1], f['properties']['bus_id'], '?'] for f in rs.features for p in f['geometry']['coordinates']]
+    for i in range(0, len(columns)):
+        xl_sheet.write(0, i, columns[i][0], xl_bold)
+    for i in range(len(entries)):
+        for j in range(0, len(columns)):
+            xl_sheet.write(i+1, j, columns[j][1](entries[i]))
+    xl_workbook.close()
+
+def export_path(file_routes, file_xlsx):
+    assembled = module('generate-assembled-data')
+    xl_workbook = assembled.sheets.workbook(file_xlsx)
+    xl_bold = xl_workbook.add_format({'bold': True})
+    assembled.assemble_sheet_routes(xl_workbook, xl_bold, file_routes)
+    xl_workbook.close()
+
+def run(name, function, file_routes, file_xlsx, rows):
+    start = time.perf_counter()
+    function(file_routes, file_xlsx)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    print('%-12s %9d rows %8.0f rows/s  peak memory %8.1f MB' % (name, rows, rows / elapsed, peak))
+
+if __name__ == "__main__":
+    (count, waypoints) = [int(a) for a in sys.argv[1:3]] if len(sys.argv) > 2 else (2000, 100)
+    directory = tempfile.mkdtemp()
+    (file_routes, file_xlsx) = (os.path.join(directory, 'routes.geojson'), os.path.join(directory, 'routes.xlsx'))
+    rows = routes_synthetic(file_routes, count, waypoints)
+    for (name, function) in [('cell-by-cell', cell_by_cell), ('export-path', export_path)]:
+        process = multiprocessing.Process(target=run, args=(name, function, file_routes, file_xlsx, rows))
+        process.start()
+        process.join()
+    for f in [file_routes, file_xlsx]:
+        os.remove(f)
+    os.rmdir(directory)
+
+## eof
@@ -0,0 +1,369 @@
+"""
+columnar.py
+
+Module containing a columnar on-disk format for the data sets passed
+between stages (students, stops, buses, and routes), as an alternative to
+pretty-printed JSON/GeoJSON files.
+
+A data set in this format is a directory whose name ends in ".columns",
+holding a "columns.json" file that describes the columns and one NumPy
+.npy file for each array of each column, which are read memory-mapped:
+  * "position" columns (a coordinate pair per row) are fixed-width (N, 2)
+    float64 arrays, and "positions" columns (a list of coordinate pairs
+    per row, such as a LineString) are an offsets array into one (M, 2)
+    float64 array;
+  * "string" columns (and "json" columns, which hold any other values as
+    JSON text) are dictionary-encoded as integer codes into a list of the
+    distinct values;
+  * "int", "float", and "bool" columns are arrays of the matching type;
+  * a column that has null or absent values in some rows has a "state"
+    array marking those rows.
+
+The read_*() and write_*() functions choose the format from the path, so
+every stage can read and write either format, and to_geojson() exports a
+columnar set of features (e.g., for display using Leaflet).
+
+A set of features can also have side tables (always columnar) that hold
+columns added by later stages, keyed by the position (a stable id) of each
+feature in the base set, so that the base never has to be rewritten. The
+side tables of "students.geojson" are named "students-<name>.columns", and
+read_features() assembles each feature from the base and its side tables.
+A side table records the fingerprints of the base (and of any side tables
+it was computed from), and it is ignored once any of those have changed.
+"""
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+import geojson
+
+import streaming # Module local to this project.
+
+SUFFIX = '.columns'
+(PRESENT, NULL, ABSENT) = (0, 1, 2)
+
+class _Absent():
+    '''
+    Placeholder for a key that does not appear in a record.
+    '''
+    def __repr__(self):
+        return 'ABSENT'
+
+MISSING = _Absent()
+
+def is_columnar(path):
+    return path.rstrip('/\\').endswith(SUFFIX)
+
+def _is_position(v):
+    return isinstance(v, (list, tuple)) and len(v) == 2 and all(type(c) is float for c in v)
+
+def _kind(values):
+    '''
+    Determine the narrowest column type that represents every value
+    exactly (on reading, ints remain ints and floats remain floats).
+    '''
+    if len(values) == 0:
+        return 'json'
+    for (kind, test) in [
+        ('bool', lambda v: type(v) is bool),
+        ('int', lambda v: type(v) is int and -2**63 <= v < 2**63),
+        ('float', lambda v: type(v) is float),
+        ('string', lambda v: type(v) is str),
+        ('position', _is_position),
+        ('positions', lambda v: isinstance(v, (list, tuple)) and all(_is_position(p) for p in v))
+      ]:
+        if all(test(v) for v in values):
+            return kind
+    return 'json'
+
+def _dictionary(values):
+    (dictionary, codes) = ({}, [])
+    for v in values:
+        codes.append(dictionary.setdefault(v, len(dictionary)))
+    return (list(dictionary), np.array(codes, dtype=np.int32))
+
+def _encode(values):
+    '''
+    Encode a list of values (with MISSING for absent keys) as a column
+    description and a dictionary of named arrays.
+    '''
+    state = np.array([ABSENT if v is MISSING else (NULL if v is None else PRESENT) for v in values], dtype=np.int8)
+    present = [v for (v, s) in zip(values, state.tolist()) if s == PRESENT]
+    kind = _kind(present)
+    (spec, arrays) = ({'type': kind}, {})
+    if kind in ('bool', 'int', 'float'):
+        dtype = {'bool': np.bool_, 'int': np.int64, 'float': np.float64}[kind]
+        arrays['values'] = np.zeros(len(values), dtype=dtype)
+        arrays['values'][state == PRESENT] = np.array(present, dtype=dtype)
+    elif kind == 'position':
+        arrays['values'] = np.zeros((len(values), 2), dtype=np.float64)
+        arrays['values'][state == PRESENT] = np.array(present, dtype=np.float64).reshape(-1, 2)
+    elif kind == 'positions':
+        lengths = np.zeros(len(values), dtype=np.int64)
+        lengths[state == PRESENT] = [len(v) for v in present]
+        arrays['offsets'] = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        arrays['values'] = np.array([p for v in present for p in v], dtype=np.float64).reshape(-1, 2)
+    else:
+        if kind == 'json':
+            present = [json.dumps(v) for v in present]
+        (spec['dictionary'], codes) = _dictionary(present)
+        arrays['codes'] = np.full(len(values), -1, dtype=np.int32)
+        arrays['codes'][state == PRESENT] = codes
+    if (state != PRESENT).any():
+        arrays['state'] = state
+    return (spec, arrays)
+
+def _write(path, columns, meta):
+    '''
+    Write named columns (lists of values of equal length) to a directory,
+    replacing any existing data set at the path.
+    '''
+    tmp = path.rstrip('/\\') + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    specs = []
+    for (k, (name, values)) in enumerate(columns):
+        (spec, arrays) = _encode(values)
+        spec['name'] = name
+        spec['arrays'] = {}
+        for (a, array) in arrays.items():
+            spec['arrays'][a] = 'c' + str(k) + '-' + a + '.npy'
+            np.save(os.path.join(tmp, spec['arrays'][a]), array)
+        specs.append(spec)
+    meta = dict(meta, columns=specs, length=len(columns[0][1]) if len(columns) > 0 else 0)
+    open(os.path.join(tmp, 'columns.json'), 'w').write(json.dumps(meta, indent=2))
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+
+class Table():
+    '''
+    Columnar data set on disk, with every array memory-mapped and each
+    column decoded into Python values only when it is requested.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.meta = json.load(open(os.path.join(path, 'columns.json'), 'r'))
+        self.specs = {spec['name']: spec for spec in self.meta['columns']}
+        self.names = [spec['name'] for spec in self.meta['columns']]
+
+    def __len__(self):
+        return self.meta['length']
+
+    def __contains__(self, name):
+        return name in self.specs
+
+    def arrays(self, name):
+        '''
+        Memory-mapped arrays of a column (e.g., 'values', 'offsets',
+        'codes', and 'state'), as a dictionary.
+        '''
+        spec = self.specs[name]
+        return {a: np.load(os.path.join(self.path, f), mmap_mode='r') for (a, f) in spec['arrays'].items()}
+
+    def column(self, name):
+        '''
+        Decode a column into a list of Python values (with MISSING for
+        rows in which the key is absent).
+        '''
+        (spec, arrays) = (self.specs[name], self.arrays(name))
+        kind = spec['type']
+        if kind == 'positions':
+            (offsets, points) = (arrays['offsets'].tolist(), arrays['values'].tolist())
+            values = [points[offsets[i]:offsets[i+1]] for i in range(len(self))]
+        elif kind == 'string':
+            dictionary = spec['dictionary']
+            values = [dictionary[c] if c >= 0 else None for c in arrays['codes'].tolist()]
+        elif kind == 'json': # Every row gets its own (mutable) copy of the value.
+            dictionary = spec['dictionary']
+            values = [json.loads(dictionary[c]) if c >= 0 else None for c in arrays['codes'].tolist()]
+        else:
+            values = arrays['values'].tolist()
+        if 'state' in arrays:
+            values = [v if s == PRESENT else (None if s == NULL else MISSING) for (v, s) in zip(values, arrays['state'].tolist())]
+        return values
+
+def _keys(dicts):
+    '''
+    All keys in a sequence of dictionaries, in order of first appearance.
+    '''
+    keys = {}
+    for d in dicts:
+        for k in d:
+            keys.setdefault(k, None)
+    return list(keys)
+
+def _rows(columns, length):
+    values = [column for (name, column) in columns]
+    return ([v[i] for v in values] for i in range(length))
+
+def write_records(path, records, indent = 2, sort_keys = True):
+    '''
+    Write a list of records (either all dictionaries or all lists of the
+    same length) to a JSON file or to a columnar data set.
+    '''
+    if not is_columnar(path):
+        open(path, 'w').write(json.dumps(records, indent=indent, sort_keys=sort_keys))
+        return
+    if len(records) > 0 and all(isinstance(r, (list, tuple)) for r in records):
+        columns = [(str(j), [r[j] for r in records]) for j in range(len(records[0]))]
+        _write(path, columns, {'kind': 'records', 'record': 'list'})
+    else:
+        columns = [(k, [r.get(k, MISSING) for r in records]) for k in _keys(records)]
+        _write(path, columns, {'kind': 'records', 'record': 'dict'})
+
+def read_records(path):
+    '''
+    Read a list of records written by write_records() (or any JSON file).
+    '''
+    if not is_columnar(path):
+        return json.load(open(path, 'r'))
+    table = Table(path)
+    columns = [(name, table.column(name)) for name in table.names]
+    if table.meta['record'] == 'list':
+        return list(_rows(columns, len(table)))
+    names = [name for (name, column) in columns]
+    return [{k: v for (k, v) in zip(names, row) if v is not MISSING} for row in _rows(columns, len(table))]
+
+def write_features(path, features, indent = None):
+    '''
+    Write a list of GeoJSON features to a GeoJSON file (as a feature
+    collection) or to a columnar data set.
+    '''
+    if not is_columnar(path):
+        open(path, 'w').write(geojson.dumps(geojson.FeatureCollection(features), indent=indent))
+        return
+    geometries = [f['geometry'] for f in features]
+    if all(g is not None and g['type'] in ('LineString', 'MultiPoint') for g in geometries) or\
+       all(g is not None and g['type'] == 'Point' for g in geometries):
+        columns = [
+            ('geometry.type', [g['type'] for g in geometries]),
+            ('geometry.coordinates', [[g['coordinates']] if g['type'] == 'Point' else g['coordinates'] for g in geometries])
+          ]
+    else:
+        columns = [('geometry', geometries)]
+    properties = [f.get('properties') or {} for f in features]
+    columns += [('properties.' + k, [p.get(k, MISSING) for p in properties]) for k in _keys(properties)]
+    _write(path, columns, {'kind': 'features'})
+
+def fingerprint(path):
+    '''
+    Digest of the contents of a file or of a columnar data set.
+    '''
+    h = hashlib.sha1()
+    files = [os.path.join(path, f) for f in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+    for file in files:
+        with open(file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def side_path(path, name):
+    (base, _) = os.path.splitext(path.rstrip('/\\'))
+    return base + '-' + name + SUFFIX
+
+def side_names(path):
+    '''
+    Names of the side tables of a set of features that exist on disk.
+    '''
+    prefix = side_path(path, '')[:-len(SUFFIX)]
+    candidates = sorted(glob.glob(glob.escape(prefix) + '*' + SUFFIX))
+    return [c[len(prefix):-len(SUFFIX)] for c in candidates if Table(c).meta.get('kind') == 'side']
+
+def write_side(path, name, columns, rows = None, using = ()):
+    '''
+    Write a side table of a set of features. Columns named
+    'properties.<key>' set a property of each feature, and columns named
+    'geometry.coordinates.<j>' insert a position into the coordinates of
+    each feature at index j. The rows are the positions of the features in
+    the base set (by default, all of them in order), and the names of the
+    side tables that the columns were computed from are listed in using.
+    '''
+    length = len(columns[0][1])
+    rows = list(range(length)) if rows is None else [int(i) for i in rows]
+    fingerprints = {'': fingerprint(path)}
+    for other in using:
+        fingerprints[other] = fingerprint(side_path(path, other))
+    _write(side_path(path, name), [('row', rows)] + columns, {'kind': 'side', 'fingerprints': fingerprints})
+
+def _apply_side(features, table):
+    rows = table.column('row')
+    for name in table.names:
+        if name.startswith('properties.'):
+            key = name[len('properties.'):]
+            for (i, v) in zip(rows, table.column(name)):
+                if v is not MISSING:
+                    features[i]['properties'][key] = v
+        elif name.startswith('geometry.coordinates.'):
+            j = int(name[len('geometry.coordinates.'):])
+            for (i, v) in zip(rows, table.column(name)):
+                if v is not MISSING:
+                    features[i]['geometry']['coordinates'].insert(j, v)
+
+def read_features(path, sides = None):
+    '''
+    Read a GeoJSON feature collection written by write_features() (or any
+    GeoJSON file), and assemble its features with the named side tables
+    (by default, all of those that are up to date). A side table that is
+    named explicitly must exist and be up to date.
+    '''
+    features = _read_features(path)
+    names = side_names(path) if sides is None else sides
+    if len(names) > 0:
+        current = {'': fingerprint(path)}
+        tables = {}
+        for name in names:
+            if not os.path.isdir(side_path(path, name)):
+                raise ValueError("Side table " + side_path(path, name) + " does not exist.")
+            current[name] = fingerprint(side_path(path, name))
+            tables[name] = Table(side_path(path, name))
+        # Apply side tables after those they were computed from.
+        for name in sorted(tables, key=lambda name: (len(tables[name].meta['fingerprints']), name)):
+            fingerprints = tables[name].meta['fingerprints']
+            if all(current.get(other) == fp for (other, fp) in fingerprints.items()):
+                _apply_side(features.features, tables[name])
+            elif sides is not None:
+                raise ValueError("Side table " + side_path(path, name) + " was computed from data that has since changed.")
+            else:
+                print("Ignoring side table " + side_path(path, name) + " (computed from data that has since changed).")
+    return features
+
+def iter_features(path, sides = None):
+    '''
+    Iterate over the features of a set of features (assembled with its
+    side tables, as by read_features()). A GeoJSON file without side
+    tables is read incrementally, so that only one feature is held in
+    memory at a time.
+    '''
+    if not is_columnar(path) and len(side_names(path) if sides is None else sides) == 0:
+        return streaming.iter_features(path)
+    return iter(read_features(path, sides)['features'])
+
+def _read_features(path):
+    if not is_columnar(path):
+        return geojson.load(open(path, 'r'))
+    table = Table(path)
+    if 'geometry' in table:
+        geometries = [geojson.GeoJSON.to_instance(g) for g in table.column('geometry')]
+    else:
+        geometries = [
+            getattr(geojson, t)(cs[0] if t == 'Point' else cs)
+            for (t, cs) in zip(table.column('geometry.type'), table.column('geometry.coordinates'))
+          ]
+    names = [name for name in table.names if name.startswith('properties.')]
+    columns = [(name[len('properties.'):], table.column(name)) for name in names]
+    keys = [k for (k, column) in columns]
+    return geojson.FeatureCollection([
+        geojson.Feature(geometry=g, properties={k: v for (k, v) in zip(keys, row) if v is not MISSING})
+        for (g, row) in zip(geometries, _rows(columns, len(table)))
+      ])
+
+def to_geojson(path, file_geojson, indent = None):
+    '''
+    Export a set of features (in either format) as a GeoJSON file.
+    '''
+    open(file_geojson, 'w').write(geojson.dumps(read_features(path), indent=indent))
+
+## eof
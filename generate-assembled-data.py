@@ -6,78 +6,64 @@ the generated data (assuming the other data sets have already been individually
 generated).
 """
 
+import os
 import json
+import shutil
+import tempfile
 import geojson
 import xlsxwriter
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
+import assembled # Module local to this project.
+import sheets # Module local to this project.
+
 def assemble_sheet_buses(xl_workbook, xl_bold, file_buses_json):
-    xl_sheet_buses = xl_workbook.add_worksheet("Buses")
-    columns = [
-        ('Bus Capacity', lambda b: int(b['Bus Capacity'])),
-        ('Bus ID', lambda b: b['Bus ID']),
-        ('Bus Longitude', lambda b: float(b['Bus Longitude'])),
-        ('Bus Latitude', lambda b: float(b['Bus Latitude'])),
-        ('Bus Type', lambda b: b['Bus Type']),
-        ('Bus Yard', lambda b: b['Bus Yard']),
-        ('Bus Yard Address', lambda b: b['Bus Yard Address'])
-      ]
-    buses = json.load(open(file_buses_json, 'r'))
-    for i in range(0, len(columns)):
-        xl_sheet_buses.write(0, i, columns[i][0], xl_bold)
-    for i in tqdm(range(len(buses)), desc="Converting JSON bus entries to XLSX rows (Buses)"):
-        for j in range(0,len(columns)):
-            xl_sheet_buses.write(i+1, j, columns[j][1](buses[i]))
+    sheets.write_sheet(xl_workbook, xl_bold, *assembled.sheet_buses(file_buses_json))
 
-def assemble_sheet_assignments(xl_workbook, xl_bold, file_students_geojson):
-    xl_sheet_assignments = xl_workbook.add_worksheet("Stop-Assignments")
-    columns = [
-        ('Student Longitude', lambda f: float(f['geometry']['coordinates'][0][0])),
-        ('Student Latitude', lambda f: float(f['geometry']['coordinates'][0][1])),
-        ('Pickup Type', lambda f: f['properties'].get('pickup')),
-        #('Grade', lambda f: f['properties'].get('grade')),
-        ('Maximum Walk Distance', lambda f: f['properties'].get('walk')),
-        #('Current School Start Time', lambda f: f['properties'].get('school_start')),
-        #('Current School End Time', lambda f: f['properties'].get('school_end')),
-        ('School Longitude', lambda f: float(f['geometry']['coordinates'][-1][0])),
-        ('School Latitude', lambda f: float(f['geometry']['coordinates'][-1][1])),
-        ('Bus ID', lambda f: f['properties'].get('bus_id')),
-        ('Stop Longitude', lambda f: float(f['geometry']['coordinates'][1][0])),
-        ('Stop Latitude', lambda f: float(f['geometry']['coordinates'][1][1]))
-      ]
-    features = json.load(open(file_students_geojson, 'r'))['features']
-    for i in range(0, len(columns)):
-        xl_sheet_assignments.write(0, i, columns[i][0], xl_bold)
-    for i in tqdm(range(len(features)), desc="Converting GeoJSON features to XLSX rows (Stop-Assignments)"):
-        for j in range(0,len(columns)):
-            xl_sheet_assignments.write(i+1, j, columns[j][1](features[i]))
+def assemble_sheet_assignments(xl_workbook, xl_bold, students):
+    sheets.write_sheet(xl_workbook, xl_bold, *assembled.sheet_assignments(students))
 
-def assemble_sheet_routes(xl_workbook, xl_bold, file_routes_geojson):
-    xl_sheet_assignments = xl_workbook.add_worksheet("Routes")
-    columns = [
-        ('Bus ID', lambda e: e[2]),
-        ('Waypoint Longitude', lambda e: e[0]),
-        ('Waypoint Latitude', lambda e: e[1])
-        #('Waypoint Address', lambda e: e[3])
-      ]
-    rs = geojson.load(open(file_routes_geojson, 'r'))
-    entries = [[p[0], p[1], f['properties']['bus_id'], '?'] for f in rs.features for p in f['geometry']['coordinates']]
-    for i in range(0, len(columns)):
-        xl_sheet_assignments.write(0, i, columns[i][0], xl_bold)
-    for i in tqdm(range(len(entries)), desc="Converting GeoJSON coordinates to XLSX rows (Routes)"):
-        for j in range(0,len(columns)):
-            xl_sheet_assignments.write(i+1, j, columns[j][1](entries[i]))
+def assemble_sheet_routes(xl_workbook, xl_bold, routes):
+    sheets.write_sheet(xl_workbook, xl_bold, *assembled.sheet_routes(routes))
 
-def assemble_xlsx(file_buses_json, file_students_geojson, file_routes_geojson, file_assembled_xlsx):
+def assemble_xlsx(file_buses_json, file_students_geojson, file_routes_geojson, file_assembled_xlsx, workers = None, parts = None):
     '''
     Converts a simulated student data set in JSON format into a human-friendly
     Excel format (with appropriate) changes to field/column names.
+
+    If a number of workers is supplied, the rows of the sheets are computed
+    concurrently in separate processes and spooled to temporary files in
+    chunks, which are then written to the workbook in order (so memory use
+    stays bounded). If a part format ('csv' or 'xlsx') is supplied, each
+    sheet is instead written (concurrently) to its own file, named after the
+    workbook and the sheet, and the list of these files is returned.
     '''
-    xl_workbook = xlsxwriter.Workbook(file_assembled_xlsx)
+    sources = [(assembled.sheet_buses, file_buses_json), (assembled.sheet_assignments, file_students_geojson), (assembled.sheet_routes, file_routes_geojson)]
+    if parts is not None:
+        if parts not in ('csv', 'xlsx'):
+            raise ValueError("Part format must be 'csv' or 'xlsx'.")
+        base = os.path.splitext(file_assembled_xlsx)[0]
+        files = [base + '-' + sheet.__name__[len('sheet_'):] + '.' + parts for (sheet, source) in sources]
+        with ProcessPoolExecutor(workers) as pool:
+            return list(pool.map(assembled.sheet_part, *zip(*sources), files))
+
+    xl_workbook = sheets.workbook(file_assembled_xlsx)
     xl_bold = xl_workbook.add_format({'bold': True})
-    assemble_sheet_buses(xl_workbook, xl_bold, file_buses_json)
-    assemble_sheet_assignments(xl_workbook, xl_bold, file_students_geojson)
-    assemble_sheet_routes(xl_workbook, xl_bold, file_routes_geojson)
+    if workers is not None and workers > 1:
+        dir_spools = tempfile.mkdtemp(prefix='.spools-', dir=os.path.dirname(os.path.abspath(file_assembled_xlsx)))
+        files = [os.path.join(dir_spools, sheet.__name__) for (sheet, source) in sources]
+        try:
+            with ProcessPoolExecutor(workers) as pool:
+                for (name, headers, file_spool) in pool.map(assembled.sheet_spool, *zip(*sources), files):
+                    sheets.write_sheet_spooled(xl_workbook, xl_bold, name, headers, file_spool)
+                    os.remove(file_spool)
+        finally:
+            shutil.rmtree(dir_spools, ignore_errors=True)
+    else:
+        assemble_sheet_buses(xl_workbook, xl_bold, file_buses_json)
+        assemble_sheet_assignments(xl_workbook, xl_bold, file_students_geojson)
+        assemble_sheet_routes(xl_workbook, xl_bold, file_routes_geojson)
     xl_workbook.close()
 
 if __name__ == "__main__":
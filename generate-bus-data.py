@@ -10,6 +10,7 @@ import xlrd
 from tqdm import tqdm
 
 from grid import Grid # Module local to this project.
+import columnar # Module local to this project.
 
 def str_ascii_only(s):
     '''
@@ -51,18 +52,18 @@ def xlsx_to_json(file_xlsx, file_json):
         entries.append(entry)
         
     # Emit the file mapping each zip code to all properties in that zip code.
-    open(file_json, 'w').write(json.dumps(entries, indent=2, sort_keys=True))
+    columnar.write_records(file_json, entries)
 
 def buses_locations_move_onto_grid(grid, file_json):
     '''
     Move all bus locations onto the grid.
     '''
-    buses = json.load(open(file_json, 'r'))
-    for bus in tqdm(buses, desc='Moving bus locations onto grid'):
-        (lon, lat) = grid.intersection_nearest((bus['Bus Longitude'], bus['Bus Latitude']))
+    buses = columnar.read_records(file_json)
+    (_, coords, _) = grid.intersection_nearest_many([(bus['Bus Longitude'], bus['Bus Latitude']) for bus in buses])
+    for (bus, (lon, lat)) in tqdm(list(zip(buses, coords.tolist())), desc='Moving bus locations onto grid'):
         bus['Bus Longitude'] = lon
         bus['Bus Latitude'] = lat
-    open(file_json, 'w').write(json.dumps(buses, indent=2, sort_keys=True))
+    columnar.write_records(file_json, buses)
 
 if __name__ == "__main__":
     grid = Grid('input/segments-prepared.geojson')
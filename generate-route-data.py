@@ -7,6 +7,8 @@ Module for automatically generating a simulated bus route data set.
 import random
 import math
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 import geojson
 import geopy.distance
 import shapely.geometry
@@ -20,27 +22,42 @@ import networkx
 from tqdm import tqdm
 
 from grid import Grid # Module local to this project.
+import distances # Module local to this project.
+import columnar # Module local to this project.
 
 class Route():
-    def __init__(self, grid, lon_lat_start, bus_id = None):
+    def __init__(self, grid, lon_lat_start, bus_id = None, weight = None):
         self.grid = grid # For computing paths and distances.
+        self.weight = weight # Paths have the fewest edges (None) or the shortest length ('distance').
         self.waypoints = [lon_lat_start]
         self.stops = [lon_lat_start]
         self.distance = 0
         self.load = 0
         self.bus_id = bus_id
 
+    def __getstate__(self):
+        # Routes are sent between processes without the (large) grid.
+        state = dict(self.__dict__)
+        state['grid'] = None
+        return state
+
     def end(self):
         return self.waypoints[-1]
 
-    def stop(self, stop_lon_lat, load = 0):
+    def stop(self, stop_lon_lat, load = 0, path = None, distance = None):
+        '''
+        Extend the route to a stop, using the supplied path (and its
+        distance) if it has already been computed.
+        '''
         end = self.waypoints[-1]
-        if not networkx.has_path(self.grid.graph, end, stop_lon_lat):
-            return False
-        path = networkx.shortest_path(self.grid.graph, end, stop_lon_lat)
+        if path is None:
+            if not self.grid.same_component(end, stop_lon_lat):
+                return False
+            path = self.grid.shortest_path(end, stop_lon_lat, self.weight)
+            distance = self.grid.path_distance(path)
         self.waypoints.extend(path[1:])
         self.stops.append(stop_lon_lat)
-        self.distance += sum(geopy.distance.vincenty(path[i], path[i+1]).miles for i in range(len(path)-1))
+        self.distance += distance
         #self.distance += networkx.shortest_path_length(self.graph, end, stop_lon_lat)
         self.load += load
         return True
@@ -48,8 +65,88 @@ class Route():
     def features(self):
         return [geojson.Feature(geometry=geojson.LineString(self.waypoints), properties={'bus_id': self.bus_id, 'load': self.load})]
 
+class SchoolPaths():
+    '''
+    Shortest paths (by distance) for routing the stops of one school. Each
+    search is a single-source Dijkstra search from the current end of a
+    route, limited to a radius that starts at twice the straight-line
+    distance to what is needed (the nearest remaining stop, or the next
+    target) and is doubled until that is reached. Distances within the
+    radius are exact, so the results match unlimited searches; only the
+    most recent search is kept. Requires the 'csr' engine. If the grid has
+    a contracted graph, the searches run on it (so stops, schools, and
+    route starts must be intersections, as they are when they are placed
+    on the grid) and paths are expanded afterwards.
+
+    Since each hop starts from a different stop, this is still about one
+    and a half searches per stop (with the doubling) rather than a few per
+    school: a search tree cannot be reused from another source, and one
+    batched search from every stop needs a dense stops-by-nodes matrix.
+    The searches are cheap because they are small. On a synthetic grid of
+    66,000 nodes, routing 1,000 stops took 1.7 s rather than 4.1 s hop by
+    hop, while on the 4,000-node Boston grid the two take about the same
+    time (see benchmarks/school-routes.py).
+    '''
+    def __init__(self, grid, stops):
+        if grid.engine != 'csr':
+            raise ValueError("Batched routing requires a grid with the 'csr' engine.")
+        self.grid = grid
+        self.graph = grid.graph if grid.contracted is None else grid.contracted.graph
+        self.ids = np.array([self.graph.node_to_id.get(tuple(stp), -1) for (stp, load) in stops], dtype=np.int64)
+        self.coords = np.array([stp for (stp, load) in stops], dtype=np.float64).reshape(-1, 2)
+        self.components = np.array([grid.components[grid.node_to_id[tuple(stp)]] if tuple(stp) in grid.node_to_id else -1 for (stp, load) in stops])
+        self.search = None # Source, radius, distances, and predecessors of the latest search.
+
+    def tree(self, i, radius):
+        '''
+        Distances and predecessors of a search from a node id, reaching at
+        least the given radius.
+        '''
+        if self.search is None or self.search[0] != i or self.search[1] < radius:
+            (dist, pred) = self.graph.dijkstra([i], radius)
+            self.search = (i, radius, dist[0], pred[0])
+        return self.search[2:]
+
+    def nearest(self, lon_lat, remaining):
+        '''
+        Index of the remaining stop that is closest to a location by network
+        distance, or None if none of them can be reached from it.
+        '''
+        (i, c) = (self.graph.node_to_id.get(tuple(lon_lat)), self.grid.node_to_id.get(tuple(lon_lat)))
+        if i is None or len(remaining) == 0:
+            return None
+        candidates = np.array(sorted(remaining))
+        candidates = candidates[(self.ids[candidates] >= 0) & (self.components[candidates] == self.grid.components[c])]
+        if len(candidates) == 0:
+            return None
+        radius = max(2 * float(np.min(distances.miles(lon_lat, self.coords[candidates], 'haversine'))), 0.01)
+        while True:
+            dist = self.tree(i, radius)[0][self.ids[candidates]]
+            k = np.argmin(dist)
+            if not np.isinf(dist[k]):
+                return int(candidates[k])
+            radius *= 2
+
+    def path(self, source, target):
+        '''
+        Path of (lon, lat) nodes and its distance between two locations, or
+        (None, None) if the target cannot be reached.
+        '''
+        (i, j) = (self.graph.node_to_id.get(tuple(source)), self.graph.node_to_id.get(tuple(target)))
+        if i is None or j is None or not self.grid.same_component(source, target):
+            return (None, None)
+        radius = max(2 * float(distances.miles(source, target, 'haversine')), 0.01)
+        while np.isinf(self.tree(i, radius)[0][j]):
+            radius *= 2
+        (dist, pred) = self.tree(i, radius)
+        path = self.graph.path_from_predecessors(pred, i, j)
+        if self.grid.contracted is not None: # Sum the edges of the expanded path in order, as a search on the full graph would.
+            path = [tuple(c) for c in self.grid.nodes[self.grid.contracted.expand(path)].tolist()]
+            return (path, self.grid.path_distance(path))
+        return ([tuple(c) for c in self.grid.nodes[path].tolist()], float(dist[j]))
+
 def stops_to_dict(file_json):
-    stops = json.load(open(file_json, 'r'))
+    stops = columnar.read_records(file_json)
     school_stop_to_load = {}
     for [sch, stp, load] in stops:
         (sch, stp) = (tuple(sch), tuple(stp))
@@ -65,89 +162,198 @@ def school_to_stops(stops):
         mapping[school] = list(stops[school].items())
     return mapping
 
-def closest(q, ps):
-    (c, d) = (ps[0], geopy.distance.vincenty(q, ps[0][0]).miles)
-    for p in ps:
-        di = geopy.distance.vincenty(q, p[0]).miles
-        if di < d:
-            (c, d) = (p, di)
+def closest(q, ps, kernel = 'geopy'):
+    ds = distances.miles(q, [p[0] for p in ps], kernel)
+    c = ps[int(np.argmin(ds))]
     return (c, [p for p in ps if p != c])
 
-def school_stops_to_routes(grid, file_students, sch_to_stoplist, buses, max_dist_miles, max_stops):
-    routes_by_school = {}
+def school_routes(grid, sch, stops, buses, bus_index, max_dist_miles, max_stops, weight = None, batched = False):
+    '''
+    Build the routes for one school by visiting its stops greedily, using
+    buses from the list starting at the given index. Normally the next stop
+    is the nearest one in a straight line and each hop is a separate path
+    search; if batched, the next stop is the nearest one by network distance
+    and the path to it is taken from the (radius-limited) search that chose
+    it, so there is one search per hop (see SchoolPaths). Returns the
+    routes, the position (within those routes) of the route serving each
+    stop, and the stops that could not be reached from the route they were
+    taken up by (which are left unassigned), or None if the buses run out.
+    '''
     routes = []
-    school_stop_to_bus = {}
-    bus_index = -1
-    for (sch, stops) in tqdm(list(sch_to_stoplist.items()), desc='Generating routes'):
+    stop_to_route = {}
+    unreached = []
 
-        # Build R-tree of stops for this school.
-        stops_rtree = rtree.index.Index()
-        for (i, ((lon, lat), count)) in enumerate(stops):
-            stops_rtree.insert(i, (lon, lat, lon, lat))
+    # Build R-tree of stops for this school.
+    stops_rtree = rtree.index.Index()
+    for (i, ((lon, lat), count)) in enumerate(stops):
+        stops_rtree.insert(i, (lon, lat, lon, lat))
+    if batched:
+        paths = SchoolPaths(grid, stops)
+        remaining = set(range(len(stops)))
 
-        # Start a new route with a new bus.
-        bus_index += 1
-        if bus_index >= len(buses):
-            print('Not enough buses.')
-            exit()
-        bus = buses[bus_index]
-        route = Route(grid, (bus['Bus Longitude'], bus['Bus Latitude']), bus['Bus ID'])
+    # Start a new route with a new bus.
+    if bus_index >= len(buses):
+        return None
+    bus = buses[bus_index]
+    route = Route(grid, (bus['Bus Longitude'], bus['Bus Latitude']), bus['Bus ID'], weight)
 
-        # Assign a bus route to every stop until none are left.
-        while True: # len(stops) > 0
-            # (((lon, lat), load), stops) = closest(route.end(), stops)
+    # Assign a bus route to every stop until none are left.
+    while True: # len(stops) > 0
+        # (((lon, lat), load), stops) = closest(route.end(), stops)
+        stop_index = paths.nearest(route.end(), remaining) if batched else None
+        if stop_index is None:
             stop_index = next(stops_rtree.nearest(route.end(), 1), None)
-            if stop_index is None: # No more stops remaining.
-                break
-            ((lon, lat), load) = stops[stop_index]
-            stops_rtree.delete(stop_index, (lon, lat, lon, lat))
-            
-            # Add the stop to the current route.
-            reached_stop = route.stop((lon, lat), load)
-            school_stop_to_bus[(sch, (lon, lat))] = bus['Bus ID'] # Record in order to update student records.
-            if not reached_stop: # Individual location cannot be reached in segment graph.
-                print("Could not reach " + str((lon, lat)) + ".")
-
-            # If there are still stops remaining but the route is becoming too long,
-            # finish it and start a new one.
-            if len(stops) > 0 and\
-               ( route.distance >= max_dist_miles or\
-                 len(route.stops) >= max_stops or\
-                 route.load >= bus['Bus Capacity'] - 5 ):
-                # Add school and record the route.
+        if stop_index is None: # No more stops remaining.
+            break
+        ((lon, lat), load) = stops[stop_index]
+        stops_rtree.delete(stop_index, (lon, lat, lon, lat))
+        
+        # Add the stop to the current route (stops in another fragment than
+        # the route are rejected, and are left unassigned).
+        if batched:
+            remaining.discard(stop_index)
+            added = route.stop((lon, lat), load, *paths.path(route.end(), (lon, lat)))
+        else:
+            added = route.stop((lon, lat), load)
+        if not added:
+            unreached.append((lon, lat))
+            continue
+        stop_to_route[(lon, lat)] = len(routes) # Record in order to update student records.
+
+        # If there are still stops remaining but the route is becoming too long,
+        # finish it and start a new one.
+        if len(stops) > 0 and\
+           ( route.distance >= max_dist_miles or\
+             len(route.stops) >= max_stops or\
+             route.load >= bus['Bus Capacity'] - 5 ):
+            # Add school and record the route.
+            if batched:
+                route.stop(sch, 0, *paths.path(route.end(), sch))
+            else:
                 route.stop(sch)
-                routes_by_school.setdefault(sch, []).append(route)
-                routes.append(route)
-
-                # Start a new route with a new bus.
-                bus_index += 1
-                if bus_index >= len(buses):
-                    print('Not enough buses.')
-                    exit()
-                bus = buses[bus_index]
-                route = Route(grid, (bus['Bus Longitude'], bus['Bus Latitude']), bus['Bus ID'])
-
-        # We exited the loop, so finish off the last (still under construction) route.
+            routes.append(route)
+
+            # Start a new route with a new bus.
+            if bus_index + len(routes) >= len(buses):
+                return None
+            bus = buses[bus_index + len(routes)]
+            route = Route(grid, (bus['Bus Longitude'], bus['Bus Latitude']), bus['Bus ID'], weight)
+
+    # We exited the loop, so finish off the last (still under construction) route.
+    if batched:
+        route.stop(sch, 0, *paths.path(route.end(), sch))
+    else:
         route.stop(sch)
-        routes_by_school.setdefault(sch, []).append(route)
-        routes.append(route)
+    routes.append(route)
+    return (routes, stop_to_route, unreached)
+
+# State of each worker process used for parallel route generation.
+_worker = {}
+
+def _worker_init(file_grid, cache, cache_dir, engine, contract, buses):
+    _worker['grid'] = Grid(file_grid, cache=cache, cache_dir=cache_dir, engine=engine, contract=contract) # Loaded from the same cache as the parent's grid.
+    _worker['buses'] = buses
+
+def _worker_school_routes(sch, stops, bus_index, *args):
+    return school_routes(_worker['grid'], sch, stops, _worker['buses'], bus_index, *args)
+
+def bus_profile(bus):
+    '''
+    The characteristics of a bus that affect the routes it is given.
+    '''
+    return (bus['Bus Longitude'], bus['Bus Latitude'], bus['Bus Capacity'])
+
+def school_routes_parallel(grid, items, buses, args, workers):
+    '''
+    Generate the routes for a list of (school, stops) pairs in a pool of
+    worker processes, yielding the routes for each school in order together
+    with the index of the first bus they use. Each school is routed with a
+    guess of the index of its first bus; when the results are merged in
+    order, the buses are reassigned to the routes in exactly the order a
+    serial run would use. A guess is accepted if every bus it used has the
+    same location and capacity as the bus that replaces it (buses come in
+    long runs from the same yard), and otherwise the school is routed again
+    from the correct index. The output always matches the serial run.
+    '''
+    (max_dist_miles, max_stops) = args[0:2]
+    guesses = np.cumsum([0] + [max(1, math.ceil(len(stops) / max(1, max_stops - 1))) for (sch, stops) in items[:-1]]).tolist()
+    with ProcessPoolExecutor(workers, initializer=_worker_init, initargs=(grid.file_path, grid.cache, grid.cache_dir, grid.engine, grid.contracted is not None, buses)) as pool:
+        futures = [pool.submit(_worker_school_routes, sch, stops, guess, *args) for ((sch, stops), guess) in zip(items, guesses)]
+        bus_index = 0
+        for ((sch, stops), guess, future) in zip(items, guesses, futures):
+            result = future.result()
+            if result is None or\
+               bus_index + len(result[0]) > len(buses) or\
+               any(bus_profile(buses[guess + j]) != bus_profile(buses[bus_index + j]) for j in range(len(result[0]))):
+                result = pool.submit(_worker_school_routes, sch, stops, bus_index, *args).result()
+            if result is None:
+                yield None
+                return
+            for route in result[0]:
+                route.grid = grid
+            yield result
+            bus_index += len(result[0])
+
+def school_stops_to_routes(grid, file_students, sch_to_stoplist, buses, max_dist_miles, max_stops, weight = None, batched = False, workers = None):
+    '''
+    Build routes for every school (see school_routes()), drawing buses from
+    the list in order. If a number of workers is supplied, the schools are
+    routed in parallel (with identical results).
+    '''
+    routes_by_school = {}
+    routes = []
+    school_stop_to_bus = {}
+    bus_index = 0
+
+    # Report the stops, schools, and bus starting locations that cannot be
+    # reached from most of the grid.
+    coords = {stp for (sch, stops) in sch_to_stoplist.items() for (stp, load) in stops + [(sch, 0)]}
+    coords |= {(bus['Bus Longitude'], bus['Bus Latitude']) for bus in buses}
+    for (lon, lat) in grid.disconnected(sorted(coords)):
+        print("Could not reach " + str((lon, lat)) + " (not connected to the main segment graph).")
+
+    items = list(sch_to_stoplist.items())
+    args = (max_dist_miles, max_stops, weight, batched)
+    parallel = workers is not None and workers > 1 and len(items) > 1
+    if parallel:
+        results = school_routes_parallel(grid, items, buses, args, workers)
+    for (sch, stops) in tqdm(items, desc='Generating routes'):
+        result = next(results) if parallel else school_routes(grid, sch, stops, buses, bus_index, *args)
+        if result is None:
+            print('Not enough buses.')
+            exit()
+        (sch_routes, stop_to_route, unreached) = result
+        for (j, route) in enumerate(sch_routes):
+            route.bus_id = buses[bus_index + j]['Bus ID']
+        for stp in unreached:
+            print("Could not route stop " + str(stp) + " for school " + str(sch) + " (not connected to the start of its bus route).")
+        for (stp, j) in stop_to_route.items():
+            school_stop_to_bus[(sch, stp)] = sch_routes[j].bus_id
+        routes_by_school[sch] = sch_routes
+        routes.extend(sch_routes)
+        bus_index += len(sch_routes)
 
-    # Update the student data with the bus assigned to each student.
-    students = geojson.load(open(file_students, 'r'))
-    for f in tqdm(students.features, desc='Updating student data with bus assignments'):
+    # Record the bus assigned to each student in a side table of the
+    # student data (leaving the student data itself untouched); students at
+    # stops that were not routed are left without one.
+    students = columnar.read_features(file_students, sides=['stops'])
+    (rows, student_buses) = ([], [])
+    for (i, f) in enumerate(tqdm(students.features, desc='Updating student data with bus assignments')):
         coords = f.geometry.coordinates
-        f['properties']['bus_id'] = school_stop_to_bus[(tuple(coords[2]), tuple(coords[1]))]
-    open(file_students, 'w').write(geojson.dumps(students, indent=2))
+        key = (tuple(coords[2]), tuple(coords[1]))
+        if key in school_stop_to_bus:
+            rows.append(i)
+            student_buses.append(school_stop_to_bus[key])
+    columnar.write_side(file_students, 'buses', [('properties.bus_id', student_buses)], rows=rows, using=['stops'])
 
     return routes
 
 if __name__ == "__main__":
-    grid = Grid('input/segments-prepared.geojson')
-    buses = json.load(open('output/buses.json', 'r'))
-    students = geojson.load(open('output/students.geojson', 'r'))
+    grid = Grid('input/segments-prepared.geojson', engine='csr')
+    buses = columnar.read_records('output/buses.json')
     stops = stops_to_dict('output/stops.json')    
-    routes = school_stops_to_routes(grid, 'output/students.geojson', school_to_stops(stops), buses, max_dist_miles=20, max_stops=30)
-    open('output/routes.geojson', 'w').write(geojson.dumps(geojson.FeatureCollection([f for r in routes for f in r.features()])))
+    routes = school_stops_to_routes(grid, 'output/students.geojson', school_to_stops(stops), buses, max_dist_miles=20, max_stops=30, workers=os.cpu_count())
+    columnar.write_features('output/routes.geojson', [f for r in routes for f in r.features()])
     open('output/routes.html', 'w').write(geoleaflet.html(geojson.FeatureCollection([f for r in routes for f in r.features()])))
 
 ## eof
\ No newline at end of file
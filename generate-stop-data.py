@@ -20,40 +20,113 @@ import networkx
 from tqdm import tqdm
 
 from grid import Grid # Module local to this project.
+import distances # Module local to this project.
+import columnar # Module local to this project.
 
-def students_to_stops(grid, file_students, file_stops, max_dist_miles, max_load):
-    students = geojson.load(open(file_students, 'r'))
+class StopIndex():
+    '''
+    Spatial hash of the stops for one school that still have room, used to
+    find the stops that may lie within a radius of a location without
+    scanning all of them. Stops are numbered in the order they are added.
+    '''
+    def __init__(self, radius_miles, kernel = 'geopy'):
+        self.radius = radius_miles
+        self.kernel = kernel
+        self.stops = []
+        self.cells = {}
+        self.cell_size = None
+
+    def extent(self, lon_lat):
+        '''
+        Size (in degrees along each axis) of a box centered on a location
+        that contains every point within the radius of it, measured
+        locally and with a generous margin (which also covers the change
+        in scale across a city-sized area).
+        '''
+        step = 0.001
+        (x, y) = lon_lat
+        per_degree = distances.miles((x, y), [(x + step, y), (x, y + step)], self.kernel) / step
+        return np.maximum(1.5 * self.radius / per_degree, 1e-9).tolist()
+
+    def cell(self, lon_lat):
+        return (math.floor(lon_lat[0] / self.cell_size[0]), math.floor(lon_lat[1] / self.cell_size[1]))
+
+    def add(self, lon_lat):
+        if self.cell_size is None: # Cells are as large as the search box.
+            self.cell_size = self.extent(lon_lat)
+        self.stops.append(lon_lat)
+        self.cells.setdefault(self.cell(lon_lat), set()).add(len(self.stops) - 1)
+        return len(self.stops) - 1
+
+    def remove(self, i):
+        self.cells[self.cell(self.stops[i])].discard(i)
+
+    def candidates(self, lon_lat):
+        '''
+        Ids (in the order the stops were added) of the stops with room that
+        may lie within the radius of a location.
+        '''
+        if self.cell_size is None:
+            return []
+        (cx, cy) = self.cell(lon_lat)
+        ids = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                ids.extend(self.cells.get((cx + dx, cy + dy), ()))
+        return sorted(ids)
+
+def students_to_stops(grid, file_students, file_stops, max_dist_miles, max_load, kernel = 'geopy'):
+    '''
+    Assign every student to a stop for their school, consolidating students
+    with an existing stop within the maximum distance (computed using the
+    named kernel from the distances module) that has room for them. The
+    stops are written to a side table of the student data (see columnar).
+    '''
+    students = columnar.read_features(file_students, sides=[])
+    student_stops = []
     stops = {}
     stop_to_load = {}
-    for f in tqdm(students.features, desc='Finding stop for each student'):
+    indices = {} # Spatial index for each school of the stops that still have room.
+    stop_to_id = {}
+    (_, nearest, _) = grid.intersection_nearest_many([f.geometry.coordinates[0] for f in students.features])
+    for (f, std_nearest) in tqdm(list(zip(students.features, nearest.tolist())), desc='Finding stop for each student'):
         coords = f.geometry.coordinates
         (std, sch) = tuple(coords[0]), tuple(coords[-1])
 
-        # Consolidate with an existing stop, if possible.
+        # Consolidate with the first existing stop that is close enough and
+        # has room, if possible.
         stp = None
-        if sch in stops:
-            for stp_existing in stops[sch]:
-                if geopy.distance.vincenty(std, stp_existing).miles <= max_dist_miles and\
+        index = indices.setdefault(sch, StopIndex(max_dist_miles, kernel))
+        candidates = index.candidates(std)
+        if len(candidates) > 0:
+            existing = [index.stops[i] for i in candidates]
+            ds = distances.miles(std, existing, kernel).tolist()
+            for (stp_existing, d) in zip(existing, ds):
+                if d <= max_dist_miles and\
                    stops[sch][stp_existing] < max_load:
                     stp = stp_existing
                     break
         if stp is None:
-            i = next(grid.rtree_nodes.nearest(std + std, 1), None)      
-            stp = tuple(grid.segments['features'][i].coordinates)
+            stp = tuple(std_nearest)
 
         stops.setdefault(sch, {})
+        if stp not in stops[sch]:
+            stop_to_id.setdefault(sch, {})[stp] = index.add(stp)
         stops[sch].setdefault(stp, 0)
         stops[sch][stp] += 1
+        if stops[sch][stp] >= max_load: # The stop is full.
+            index.remove(stop_to_id[sch][stp])
 
         # Update student entry with the stop information.
         f.geometry.coordinates = [coords[0], stp, coords[-1]]
+        student_stops.append(stp)
 
-    open(file_students, 'w').write(geojson.dumps(students, indent=2))
-    open(file_stops, 'w').write(json.dumps(stops_to_json_compatible(stops), indent=2))
+    columnar.write_side(file_students, 'stops', [('geometry.coordinates.1', student_stops)])
+    columnar.write_records(file_stops, stops_to_json_compatible(stops), sort_keys=False)
     return (students, stops)
 
 def stops_to_dict(file_json):
-    stops = json.load(open(file_json, 'r'))
+    stops = columnar.read_records(file_json)
     school_stop_to_load = {}
     for [sch, stp, load] in stops:
         (sch, stp) = (tuple(sch), tuple(stp))
@@ -72,6 +145,6 @@ def stops_to_json_compatible(stops):
 
 if __name__ == "__main__":
     grid = Grid('input/segments-prepared.geojson')
-    (students, stops) = students_to_stops(grid, 'output/students.geojson', 'output/stops.json', 0.3, 15)
+    (students, stops) = students_to_stops(grid, 'output/students.geojson', 'output/stops.json', 0.3, 15, kernel='vincenty')
 
 ## eof
\ No newline at end of file
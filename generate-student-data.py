@@ -6,67 +6,115 @@ Module for automatically generating a simulated student data set.
 
 import requests
 import random
+import os
 import math
+import time
 import json
+import shutil
+import hashlib
+import tempfile
 import geojson
 import geopy.distance
+import shapely
 import shapely.geometry
 import xlsxwriter
 import rtree
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
 from grid import Grid # Module local to this project.
+import distances # Module local to this project.
+import streaming # Module local to this project.
+import columnar # Module local to this project.
+import sheets # Module local to this project.
 
-def properties_by_zipcode(file_properties, file_census_blocks, file_output):
+MILES_PER_DEGREE = distances.RADIUS_MEAN * distances.MILES_PER_KILOMETER * math.pi / 180 # Of latitude.
+
+def census_blocks_containing(tree, points):
+    """
+    Find the census block containing each of an array of (lon, lat) points
+    in one batch, given an STRtree of the block shapes; points that are not
+    inside any block are assigned the nearest block instead. Returns the
+    block index for every point and a mask of the points that were inside
+    their block.
+    """
+    points = shapely.points(np.asarray(points, dtype=np.float64).reshape(-1, 2))
+    blocks = np.full(len(points), -1, dtype=np.int64)
+    if len(points) == 0 or len(tree) == 0:
+        return (blocks, blocks >= 0)
+
+    # Where a point lies in more than one block, use the first block.
+    (pi, bi) = tree.query(points, predicate='within')
+    order = np.lexsort((bi, pi))
+    (pi, bi) = (pi[order], bi[order])
+    (contained, first) = np.unique(pi, return_index=True)
+    blocks[contained] = bi[first]
+    inside = blocks >= 0
+
+    # Fall back to the nearest block.
+    missing = np.flatnonzero(~inside)
+    if len(missing) > 0:
+        (mi, mb) = tree.query_nearest(points[missing])
+        order = np.lexsort((mb, mi))
+        (mi, mb) = (mi[order], mb[order])
+        (nearest, first) = np.unique(mi, return_index=True)
+        blocks[missing[nearest]] = mb[first]
+    return (blocks, inside)
+
+def properties_by_zipcode(file_properties, file_census_blocks, file_output, chunk_size = 50000):
     """
     Build a JSON file grouping all residential properties by zip code
     and assigning the US Census Bureau Census Block numbers (FIPS codes)
-    to them.
+    to them. Both input files are read incrementally and the output is
+    written one zip code at a time, so only the census block shapes and
+    one chunk of properties are held in memory at once.
     """
-    # Get the (feature, shape) pairs for each census block.
+    # Get the (FIPS code, shape) pairs for each census block.
     block_shapes = [
-        (f, shapely.geometry.shape(f['geometry'])) 
-        for f in tqdm(geojson.loads(open(file_census_blocks).read())['features'], desc='Building census block shape list') 
+        (f['properties']['CODE'], shapely.geometry.shape(f['geometry']))
+        for f in tqdm(streaming.iter_features(file_census_blocks), desc='Building census block shape list')
         if f['geometry'] is not None
       ]
 
-    # Build R-tree index for the census block shapes to make it easier to
-    # find the block closest to a point.
-    rtidx = rtree.index.Index()
-    for i in tqdm(range(len(block_shapes)), desc='Building R-tree of census blocks'):
-        (f, s) = block_shapes[i]
-        rtidx.insert(i, s.bounds)
-
-    # Build dictionary mapping each zip code to all properties in that zip.
-    properties = json.load(open(file_properties, 'r'))
-    boston_zips = {}
-    for i in tqdm(properties, desc='Building zip-to-property dictionary'):
-        ps = properties[i].get('properties')
-        if ps.get('zipcode') not in ["NULL", None] and\
-           ps.get('address') not in ["NULL", None] and\
-           ps.get('type') == 'Residential':
-            property = properties[i]
-
-            # Given the location of a property, loop through all nearby
-            # block shapes (according to the R-tree index) and assign
-            # the shape's FIPS code to that property.
-            (lat, lon) = property['geometry']['coordinates']
-            for (f, s) in [block_shapes[i] for i in rtidx.nearest((lon, lat, lon, lat), 1)]:
-                if s.contains(shapely.geometry.Point(lon, lat)):
-                    property['geocode'] = f['properties']['CODE']
-                    break
+    # Build an STRtree index of the census block shapes so that every
+    # chunk of properties can be matched against all candidate blocks at once.
+    tree = shapely.STRtree([s for (code, s) in block_shapes])
 
-            boston_zips.setdefault(ps['zipcode'], {})
-            boston_zips[ps['zipcode']][i] = property
+    # Assign the FIPS code of the block containing each property (or of the
+    # nearest block) to that property, and add the property to its zip code.
+    (total, matched) = (0, 0)
+    with streaming.GroupedJSONWriter(file_output) as boston_zips:
+        def assign(chunk):
+            (blocks, inside) = census_blocks_containing(tree, [tuple(reversed(p['geometry']['coordinates'])) for (i, p) in chunk])
+            for ((i, property), b) in zip(chunk, blocks.tolist()):
+                if b >= 0:
+                    property['geocode'] = block_shapes[b][0]
+                boston_zips.add(property['properties']['zipcode'], i, property)
+            return int(inside.sum())
 
-            # The above could alternatively be implemented via API
-            # calls to the Census Block Conversions API. However,
-            # the service does not use R-tree indices so it's slower.
-            #geocode = json.loads(requests.get('http://data.fcc.gov/api/block/find?format=json&latitude=' + str(lat) + '&longitude=' + str(lon) + '&showall=true').text)["Block"]["FIPS"][0:-3]
-            #boston_zips[ps['zipcode']][i]['geocode'] = geocode
+        chunk = []
+        for (i, property) in tqdm(streaming.iter_key_values(file_properties), desc='Building zip-to-property dictionary'):
+            ps = property.get('properties')
+            if ps.get('zipcode') not in ["NULL", None] and\
+               ps.get('address') not in ["NULL", None] and\
+               ps.get('type') == 'Residential':
+                chunk.append((i, property))
+            if len(chunk) >= chunk_size:
+                (total, matched) = (total + len(chunk), matched + assign(chunk))
+                chunk = []
+        (total, matched) = (total + len(chunk), matched + assign(chunk))
 
-    # Emit the file mapping each zip code to all properties in that zip code.
-    open(file_output, 'w').write(json.dumps(boston_zips, indent=2, sort_keys=True))
+        # The above could alternatively be implemented via API
+        # calls to the Census Block Conversions API. However,
+        # the service does not use spatial indices so it's slower.
+        #geocode = json.loads(requests.get('http://data.fcc.gov/api/block/find?format=json&latitude=' + str(lat) + '&longitude=' + str(lon) + '&showall=true').text)["Block"]["FIPS"][0:-3]
+        #boston_zips[ps['zipcode']][i]['geocode'] = geocode
+    print(
+        "Census blocks: " + str(matched) + " of " + str(total) + " properties " +
+        "(" + ("%.1f" % (100.0 * matched / max(1, total))) + "%) lie inside a block; " +
+        "the rest were assigned the nearest block."
+      )
 
 def percentages_csv_to_json(file_csv, file_json):
     """
@@ -86,10 +134,12 @@ def percentages_csv_to_json(file_csv, file_json):
           }
     open(file_json, 'w').write(json.dumps(zip_to_percentages, indent=2, sort_keys=True))
 
-def zip_to_school_to_location(file_schools, file_student_zip_school_percentages):
+def zip_to_school_to_location(file_schools, file_student_zip_school_percentages, rng = random):
     """
     Reads the school CSV to construct a JSON with schools ordered by zipcode.
     and extended with attendance information based on the percentages data.
+    ZIP Codes and the schools in each are in sorted order, and bell times
+    are drawn from the supplied random number generator.
     """
     rows = open(file_schools, 'r').read().split("\n")
     fields = rows[0].split("\t")
@@ -111,102 +161,257 @@ def zip_to_school_to_location(file_schools, file_student_zip_school_percentages)
                 'attendance': sum([math.ceil((zip_student_percentages[z]['schools'][r['name']] if r['name'] in zip_student_percentages[z]['schools'] else 0 ) * zip_student_percentages[z]['total']) for z in zip_student_percentages]),
                 'attendance_share': sum([math.ceil((zip_student_percentages[z]['schools'][r['name']] if r['name'] in zip_student_percentages[z]['schools'] else 0 ) * zip_student_percentages[z]['total']) for z in zip_student_percentages]) / total_students
               }
-            for r in rows[1:] if zip == r['zip']
+            for r in sorted(rows[1:], key=lambda r: r['name'].strip()) if zip == r['zip']
           }
-        for zip in zips
+        for zip in sorted(zips)
       }
-    return school_to_bell_time(zip_to_name_to_loc)
+    return school_to_bell_time(zip_to_name_to_loc, rng)
 
-def school_to_bell_time(school_json):
+def school_to_bell_time(school_json, rng = random):
     """
     Takes the school JSON output from zip_to_school_to_location and assigns
-    bell times.
+    bell times (drawn from the supplied random number generator, visiting
+    ZIP Codes and schools in sorted order).
     """
     attendance_percents = {'07:30:00':0.0, '08:30:00':0.0, '09:30:00':0.0}
     attendance_thresholds = {'07:30:00':40.0, '08:30:00':40.0, '09:30:00':20.0}
-    for zipcode in school_json:
-        for schools in school_json[zipcode]:
+    for zipcode in sorted(school_json):
+        for schools in sorted(school_json[zipcode]):
             while True:
-                selected_time = random.choice(['07:30:00', '08:30:00', '09:30:00'])
+                selected_time = rng.choice(['07:30:00', '08:30:00', '09:30:00'])
                 if attendance_percents[selected_time] < attendance_thresholds[selected_time]:
                     school_json[zipcode][schools]['start'] = selected_time
                     if selected_time == '07:30:00':
-                        school_json[zipcode][schools]['end'] = random.choice(['14:10:00', '15:00:00'])
+                        school_json[zipcode][schools]['end'] = rng.choice(['14:10:00', '15:00:00'])
                     if selected_time == '08:30:00':
-                        school_json[zipcode][schools]['end'] = random.choice(['15:10:00', '16:00:00'])
+                        school_json[zipcode][schools]['end'] = rng.choice(['15:10:00', '16:00:00'])
                     if selected_time == '09:30:00':
-                        school_json[zipcode][schools]['end'] = random.choice(['16:10:00', '17:00:00'])
+                        school_json[zipcode][schools]['end'] = rng.choice(['16:10:00', '17:00:00'])
                     attendance_percents[selected_time] += school_json[zipcode][schools]['attendance_share']
                     break
     return school_json
 
-def students_simulate(grid, file_schools, file_properties_by_zipcode, file_neighborhood_safety, file_grade_safe_distance, file_student_zip_school_percentages, file_students):
+class ZipProperties():
+    """
+    The residential properties in one ZIP Code, loaded once into a list and
+    a coordinate array. For each school, the distances from all of the
+    properties to it are computed in one vectorized kernel call (the first
+    time a student of that school is sampled), and cached along with the
+    mask of properties that are far enough from it to be eligible.
+    """
+    def __init__(self, props, kernel = 'geopy', minimum = 0.65):
+        self.props = list(props.values())
+        self.coords = np.array([tuple(reversed(prop['geometry']['coordinates'])) for prop in self.props], dtype=np.float64).reshape(-1, 2)
+        self.kernel = kernel
+        self.minimum = minimum
+        self.school_to_distances = {}
+
+    def __len__(self):
+        return len(self.props)
+
+    def school(self, school_loc):
+        """
+        The distances from every property to a school, and which of them
+        are at least the minimum distance away.
+        """
+        key = tuple(school_loc)
+        if key not in self.school_to_distances:
+            dists = np.asarray(distances.miles(self.coords, school_loc, self.kernel), dtype=np.float64).reshape(-1)
+            self.school_to_distances[key] = (dists, dists >= self.minimum)
+        return self.school_to_distances[key]
+
+    def sample_nearest(self, school_loc, r, rng = random):
+        """
+        Sample r properties and return the index and distance of the one
+        nearest to the school among those at least the minimum distance
+        away from it (preferring the earliest sampled among equally near
+        ones), or None if there is no such property.
+        """
+        (dists, eligible) = self.school(school_loc)
+        indices = np.array(rng.sample(range(len(self.props)), r), dtype=np.int64)
+        candidates = np.where(eligible[indices], dists[indices], np.inf)
+        k = int(np.argmin(candidates))
+        if np.isinf(candidates[k]):
+            return None
+        return (int(indices[k]), float(candidates[k]))
+
+def zip_students(zip, zip_props, zip_percentages, schools_to_data, school_to_loc, neighborhood_safety, grade_safe_distance, kernel = 'geopy', rng = random, desc = None, scale = 1, jitter_miles = 0):
+    """
+    Simulate (and yield, one at a time) the students living in one ZIP
+    Code, drawing all random choices from the supplied random number
+    generator. The number of students is multiplied by the scale factor,
+    and if a jitter distance is supplied then every home is displaced from
+    its property by up to that distance along each axis (the length of the
+    trip is still that of the property), producing a synthetic city that
+    is denser than the one in the property data.
+    """
+    for (school, fraction) in tqdm(zip_percentages['schools'].items(), desc=desc, disable=desc is None):
+        if school in schools_to_data:
+            school_loc = school_to_loc[school]
+            for ty in ['corner', 'd2d']:
+                for student in range(int(1.0 * fraction * zip_percentages[ty] * scale)):
+                    r = rng.randint(10,20)
+                    nearest = zip_props.sample_nearest(school_loc, r, rng=rng)
+                    attempts = 0
+                    while nearest is None and attempts < 100:
+                        attempts += 1
+                        r = min(len(zip_props), r + 10)
+                        nearest = zip_props.sample_nearest(school_loc, r, rng=rng)
+                    if nearest is not None:
+                        (j, length) = nearest
+                        location = zip_props.props[j]
+                        end = school_loc
+                        start = tuple(reversed(location['geometry']['coordinates']))
+                        if jitter_miles > 0:
+                            (lon, lat) = start
+                            degrees = jitter_miles / MILES_PER_DEGREE
+                            start = (
+                                round(lon + rng.uniform(-degrees, degrees) / math.cos(math.radians(lat)), 6),
+                                round(lat + rng.uniform(-degrees, degrees), 6)
+                              )
+                        geometry = geojson.Point(start)
+                        geometry = geojson.LineString([start, end])
+
+                        grade = rng.choice('K123456')
+                        geocode = location.get('geocode')
+                        geocode = geocode[0:-4] if geocode is not None else None
+                        safety = neighborhood_safety.get(geocode)
+
+                        properties = {
+                            'length':length,
+                            'zip':zip,
+                            'pickup':ty, 'grade':grade,
+                            'geocode':geocode, 'safety':safety,
+                            'walk':grade_safe_distance[grade].get(safety),
+                            'school': schools_to_data[school]['name'],
+                            'school_address': schools_to_data[school]['address'],
+                            'school_start': schools_to_data[school]['start'],
+                            'school_end': schools_to_data[school]['end']
+                          }
+                        if type(location['properties']['address']) == str and len(location['properties']['address'].split(" ")) >= 2:
+                            parts = location['properties']['address'].strip().split(" ")
+                            (number, street) = (parts[0], " ".join(parts[1:]))
+                            properties['number'] = number
+                            properties['street'] = street.split("#")[0].strip() # No unit numbers.
+                        yield geojson.Feature(geometry=geometry, properties=properties)
+
+def zip_seed(seed, zip):
+    """
+    Seed of the random number generator for one ZIP Code, derived from the
+    master seed (and independent of the order in which ZIPs are processed).
+    """
+    return int.from_bytes(hashlib.sha256((str(seed) + ':' + str(zip)).encode()).digest()[:8], 'big')
+
+# Data shared by all the ZIP Codes, set up once in each worker process.
+_worker = {}
+
+def _worker_init(*shared):
+    _worker['shared'] = shared
+
+def _seeded_zip_students(seed, zip, props, zip_percentages, kernel, scale, jitter_miles):
+    rng = random.Random(zip_seed(seed, zip))
+    return zip_students(zip, ZipProperties(props, kernel), zip_percentages, *_worker['shared'], kernel=kernel, rng=rng, scale=scale, jitter_miles=jitter_miles)
+
+def _worker_zip_students(task):
+    '''
+    Simulate the students of one ZIP Code, either returning them or (if a
+    file is supplied) encoding them into that file as one part of the
+    output and returning the file and the number of students.
+    '''
+    (file_part, args) = task
+    features = _seeded_zip_students(*args)
+    if file_part is None:
+        return list(features)
+    return (file_part, streaming.FeatureCollectionWriter.write_features(file_part, features, indent=2))
+
+def students_simulate(grid, file_schools, file_properties_by_zipcode, file_neighborhood_safety, file_grade_safe_distance, file_student_zip_school_percentages, file_students, kernel = 'geopy', seed = None, workers = None, scale = 1, jitter_miles = 0, stream = False):
     """
     Builds and emits a simulated student data set that randomly assigns
     a school (and other characteristics) to every student based on
-    appropriate distributions and other criteria.
+    appropriate distributions and other criteria. Distances are computed
+    using the named kernel from the distances module.
+
+    ZIP Codes (and schools) are processed in sorted order. By default, all
+    random choices are drawn from the global random state. If a seed is
+    supplied, school bell times are instead drawn from a random number
+    generator seeded with it, and each ZIP Code uses its own generator
+    derived from it, optionally across a number of worker processes; the
+    output then depends only on the seed (and not on the number of workers
+    or on the hash seed of the Python process).
+
+    The scale factor and jitter distance can be used to generate larger
+    populations (see zip_students()). In streaming mode the students are
+    written to the (GeoJSON) output file as they are generated rather
+    than collected, and only the number of students is returned.
     """
+    if stream and columnar.is_columnar(file_students):
+        raise ValueError("Streaming output requires a GeoJSON file.")
     neighborhood_safety = json.load(open(file_neighborhood_safety))
     grade_safe_distance = json.load(open(file_grade_safe_distance))
     props = json.load(open(file_properties_by_zipcode, 'r'))
     percentages = json.load(open(file_student_zip_school_percentages, 'r'))
-    schools = zip_to_school_to_location(file_schools, file_student_zip_school_percentages)
+    schools = zip_to_school_to_location(file_schools, file_student_zip_school_percentages, random if seed is None else random.Random(seed))
     schools_to_data = {school:schools[zip][school] for zip in schools for school in schools[zip]}
+    (_, school_locs, _) = grid.intersection_nearest_many([schools_to_data[school]['location'] for school in schools_to_data])
+    school_to_loc = {school: school_locs[k].tolist() for (k, school) in enumerate(schools_to_data)}
+    shared = (schools_to_data, school_to_loc, neighborhood_safety, grade_safe_distance)
+    time_start = time.time()
+
+    # Either collect the students or write them out as they are generated.
     features = []
-    zips = list(percentages.keys() & props.keys())
+    writer = streaming.FeatureCollectionWriter(file_students, indent=2) if stream else None
+    def emit(zip_features):
+        if writer is None:
+            features.extend(zip_features)
+        else:
+            for f in zip_features:
+                writer.write(f)
+
+    zips = sorted(percentages.keys() & props.keys())
+    simulated = []
     for i in range(len(zips)):
         zip = zips[i]
         progress = " (" + str(i+1) + "/" + str(len(zips)) + ")"
         if zip not in schools or len(schools[zip]) == 0:
             print("No schools found in ZIP Code " + zip + progress + ".")
+        elif seed is None:
+            emit(zip_students(zip, ZipProperties(props[zip], kernel), percentages[zip], *shared, kernel=kernel, desc='Processing ZIP ' + zip + progress, scale=scale, jitter_miles=jitter_miles))
+        else:
+            simulated.append(zip)
+
+    # Merge the students of each ZIP Code in sorted ZIP Code order.
+    if len(simulated) > 0:
+        args = [(seed, zip, props[zip], percentages[zip], kernel, scale, jitter_miles) for zip in simulated]
+        if workers is not None and workers > 1:
+            dir_parts = tempfile.mkdtemp(prefix='.parts-', dir=os.path.dirname(os.path.abspath(file_students))) if stream else None
+            tasks = [(None if dir_parts is None else os.path.join(dir_parts, str(k)), a) for (k, a) in enumerate(args)]
+            try:
+                with ProcessPoolExecutor(workers, initializer=_worker_init, initargs=shared) as pool:
+                    for result in tqdm(pool.map(_worker_zip_students, tasks), total=len(tasks), desc='Processing ZIPs'):
+                        if writer is None:
+                            features.extend(result)
+                        else:
+                            writer.write_part(*result)
+            finally:
+                if dir_parts is not None:
+                    shutil.rmtree(dir_parts, ignore_errors=True)
         else:
-            for (school, fraction) in tqdm(percentages[zip]['schools'].items(), desc='Processing ZIP ' + zip + progress):
-                if school in schools_to_data:
-                    school_loc = grid.intersection_nearest(schools_to_data[school]['location'])
-                    for ty in ['corner', 'd2d']:
-                        for student in range(int(1.0 * fraction * percentages[zip][ty])):
-                            r = random.randint(10,20)
-                            locations = [(geopy.distance.vincenty(tuple(reversed(prop['geometry']['coordinates'])), school_loc).miles, prop) for prop in random.sample(list(props[zip].values()), r)]
-                            locations = [(d, p) for (d, p) in locations if d >= 0.65]
-                            locations = list(sorted(locations, key=lambda t: t[0]))
-                            attempts = 0
-                            while len(locations) == 0 and attempts < 100:
-                                attempts += 1
-                                r = min(len(props[zip].values()), r + 10)
-                                locations = [(geopy.distance.vincenty(tuple(reversed(prop['geometry']['coordinates'])), school_loc).miles, prop) for prop in random.sample(list(props[zip].values()), r)]
-                                locations = [(d, p) for (d, p) in locations if d >= 0.65]
-                                locations = list(sorted(locations, key=lambda t: t[0]))
-                            if len(locations) > 0:
-                                location = locations[0][1]
-                                end = school_loc
-                                start = tuple(reversed(location['geometry']['coordinates']))
-                                geometry = geojson.Point(start)
-                                geometry = geojson.LineString([start, end])
-
-                                grade = random.choice('K123456')
-                                geocode = location.get('geocode')
-                                geocode = geocode[0:-4] if geocode is not None else None
-                                safety = neighborhood_safety.get(geocode)
-
-                                properties = {
-                                    'length':geopy.distance.vincenty(start, end).miles,
-                                    'zip':zip,
-                                    'pickup':ty, 'grade':grade,
-                                    'geocode':geocode, 'safety':safety,
-                                    'walk':grade_safe_distance[grade].get(safety),
-                                    'school': schools_to_data[school]['name'],
-                                    'school_address': schools_to_data[school]['address'],
-                                    'school_start': schools_to_data[school]['start'],
-                                    'school_end': schools_to_data[school]['end']
-                                  }
-                                if type(location['properties']['address']) == str and len(location['properties']['address'].split(" ")) >= 2:
-                                    parts = location['properties']['address'].strip().split(" ")
-                                    (number, street) = (parts[0], " ".join(parts[1:]))
-                                    properties['number'] = number
-                                    properties['street'] = street.split("#")[0].strip() # No unit numbers.
-                                features.append(geojson.Feature(geometry=geometry, properties=properties))
-
-    open(file_students, 'w').write(geojson.dumps(geojson.FeatureCollection(features), indent=2))
+            _worker_init(*shared)
+            for a in tqdm(args, desc='Processing ZIPs'):
+                emit(_seeded_zip_students(*a))
+
+    if writer is None:
+        columnar.write_features(file_students, features, indent=2)
+    else:
+        writer.close()
+    count = len(features) if writer is None else writer.count
+    duration = time.time() - time_start
+    print(
+        "Simulated " + str(count) + " students in " + ("%.1f" % duration) + " seconds " +
+        "(" + ("%.0f" % (count / max(duration, 1e-9))) + " students/second)."
+      )
+    if stream:
+        return count
     features = list(reversed(sorted(features, key=lambda f: f['properties']['length'])))
     return geojson.FeatureCollection(features)
 
@@ -215,9 +420,8 @@ def geojson_to_xlsx(geojson_file, xlsx_file):
     Converts a simulated student data set in JSON format into a human-friendly
     Excel format (with appropriate) changes to field/column names.
     """
-    xl_workbook = xlsxwriter.Workbook(xlsx_file)
+    xl_workbook = sheets.workbook(xlsx_file)
     xl_bold = xl_workbook.add_format({'bold': True})
-    xl_sheet = xl_workbook.add_worksheet("Student Information")
     columns = [
         ('Street Number', lambda f: f['properties'].get('number')),
         ('Street Name', lambda f: f['properties'].get('street')),
@@ -236,12 +440,8 @@ def geojson_to_xlsx(geojson_file, xlsx_file):
         ('School Longitude', lambda f: float(f['geometry']['coordinates'][-1][0])),
         ('School Latitude', lambda f: float(f['geometry']['coordinates'][-1][1]))
       ]
-    features = json.load(open(geojson_file, 'r'))['features']
-    for i in range(0, len(columns)):
-        xl_sheet.write(0, i, columns[i][0], xl_bold)
-    for i in tqdm(range(len(features)), desc="Converting GeoJSON features to XLSX rows"):
-        for j in range(0,len(columns)):
-            xl_sheet.write(i+1, j, columns[j][1](features[i]))
+    features = columnar.iter_features(geojson_file, sides=[])
+    sheets.write_sheet(xl_workbook, xl_bold, "Student Information", columns, features, desc="Converting GeoJSON features to XLSX rows")
     xl_workbook.close()
 
 if __name__ == "__main__":
@@ -259,7 +459,8 @@ if __name__ == "__main__":
           'input/neighborhood-safety.json',
           'input/grade-safe-distance.json',
           'input/student-zip-school-percentages.json',
-          'output/students.geojson'
+          'output/students.geojson',
+          kernel='vincenty'
         )
     open('output/students.js', 'w').write('var obj = ' + geojson.dumps(students) + ';')
     geojson_to_xlsx('output/students.geojson', 'output/students.xlsx')
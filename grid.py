@@ -4,82 +4,556 @@ grid.py
 Module containing class for working with a street grid.
 """
 
+import os
+import math
 import json
+import shutil
+import hashlib
+import numpy as np
 import geojson
-import geopy.distance
 import shapely.geometry
 from geoql import geoql
 import geoleaflet
 import folium
 import rtree
 import networkx
+import scipy.sparse
+import scipy.sparse.csgraph
+import scipy.spatial
 from tqdm import tqdm
 
+from graph import GraphCSR, ContractedGraph # Module local to this project.
+import distances # Module local to this project.
+
+# Bump whenever the layout of the cached arrays or index files changes, so
+# that caches written by an older version of this module are rebuilt.
+CACHE_VERSION = 3
+
+# Scale applied to great-circle distances so that they never exceed the
+# (ellipsoidal) Vincenty distances used as edge lengths; the two differ by
+# less than 0.6% anywhere on the globe.
+GREAT_CIRCLE_SCALE = 0.99
+
+def great_circle_miles(a, b):
+    '''
+    Lower bound on the Vincenty distance in miles between two points given
+    in the same coordinate order that geopy.distance.vincenty() receives
+    them throughout this project; suitable as an A* heuristic.
+    '''
+    (p1, l1, p2, l2) = (math.radians(a[0]), math.radians(a[1]), math.radians(b[0]), math.radians(b[1]))
+    h = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin((l2 - l1) / 2) ** 2
+    return GREAT_CIRCLE_SCALE * 2 * distances.RADIUS_MEAN * distances.MILES_PER_KILOMETER * math.asin(min(1.0, math.sqrt(h)))
+
+def rtree_from_bounds(bounds, ids = None, basename = None):
+    '''
+    Bulk load an R-tree from an array of (min x, min y, max x, max y)
+    bounds, one row per entry, keyed by the supplied ids (or by the row
+    index). Stream loading packs the tree (using the STR algorithm), which
+    is much faster than inserting one entry at a time and yields a tree
+    that answers queries faster. If a base name is supplied, the tree is
+    stored on disk.
+    '''
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    ids = range(len(bounds)) if ids is None else np.asarray(ids).tolist()
+    args = [] if basename is None else [basename]
+    if len(bounds) == 0: # The stream loader rejects an empty stream.
+        return rtree.index.Index(*args)
+    return rtree.index.Index(*args, ((i, tuple(b), None) for (i, b) in zip(ids, bounds.tolist())))
+
 class Grid():
     @staticmethod
-    def prepare(file_segments, file_segments_filtered):
+    def snap(coords, lengths, tolerance):
         '''
-        Prepare a "clean" segments file given an input segments file.
+        Snap nearly coincident segment endpoints, given an array of (lon, lat)
+        rows holding the coordinates of consecutive segments with the given
+        lengths. Taking the endpoints in order of appearance, each one that
+        has not been snapped yet keeps its coordinate and snaps every later
+        endpoint of a different segment within the tolerance (in degrees) of
+        it, so no coordinate moves by more than the tolerance and no segment
+        has its two ends snapped together. Interior coordinates are left as
+        they are. Consecutive duplicates within a segment are then dropped,
+        and segments that collapse to a single point are dropped entirely.
+        Returns the coordinates and the new lengths (zero for a segment that
+        was dropped).
         '''
-        segments = geoql.load(open(file_segments, 'r'))
-        features = []
-        for f in tqdm(segments.features, desc='Filtering road segments'):
-            if f.type == 'Feature':
-                f.properties = []
-                features.append(f)
-        segments.features = features
-        segments = segments.node_edge_graph()
-        segments.dump(open(file_segments_filtered, 'w'), sort_keys=True)
+        feature_of = np.repeat(np.arange(len(lengths)), lengths)
+        offsets = np.cumsum(lengths) - lengths
+        nonempty = lengths > 0
+        ends = np.sort(np.concatenate([offsets[nonempty], (offsets + lengths - 1)[nonempty]]))
+        (unique, first, inverse) = np.unique(coords[ends], axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.ravel()
+
+        # The segments at each distinct endpoint, and its nearby endpoints.
+        segments = [set() for _ in range(len(unique))]
+        for (u, i) in zip(inverse.tolist(), feature_of[ends].tolist()):
+            segments[u].add(i)
+        pairs = scipy.spatial.cKDTree(unique).query_pairs(tolerance, output_type='ndarray')
+        nearby = [[] for _ in range(len(unique))]
+        for (u, v) in pairs.tolist():
+            nearby[u].append(v)
+            nearby[v].append(u)
+
+        representative = np.arange(len(unique))
+        snapped = np.zeros(len(unique), dtype=bool)
+        for u in np.argsort(first, kind='stable').tolist():
+            if snapped[u]:
+                continue
+            for v in sorted(nearby[u], key=lambda v: first[v]):
+                if first[v] > first[u] and not snapped[v] and segments[u].isdisjoint(segments[v]):
+                    (representative[v], snapped[v]) = (u, True)
+                    segments[u] |= segments[v]
+        coords = coords.copy()
+        coords[ends] = unique[representative[inverse]]
+
+        keep = np.ones(len(coords), dtype=bool)
+        keep[1:] = (feature_of[1:] != feature_of[:-1]) | np.any(coords[1:] != coords[:-1], axis=1)
+        counts = np.bincount(feature_of[keep], minlength=len(lengths))
+        keep &= counts[feature_of] > 1
+        return (coords[keep], np.where(counts > 1, counts, 0))
 
     @staticmethod
-    def segments_networkx(segments):
+    def prepare(file_segments, file_segments_filtered, tolerance = None, cache = True, cache_dir = None):
         '''
-        Convert a GeoJSON graph generated by the geoql function
-        node_edge_graph() into a networkx representation.
+        Prepare a "clean" segments file given an input segments file. The
+        result is the same as that of the geoql function node_edge_graph():
+        Point features for every coordinate that appears more than once
+        (in order of first appearance), followed by a Feature for every run
+        of coordinates between two such points within a segment (with the
+        last coordinate repeated), without properties. The points are found
+        by sorting the coordinate array rather than by repeated lookups.
+        If a tolerance (in degrees) is supplied, nearly coincident segment
+        endpoints are snapped together first (see snap()). Unless caching
+        is disabled, the cache entry for the prepared file is written
+        directly from the same arrays, so that Grid can load the file
+        without parsing it.
         '''
-        graph = networkx.Graph()
-        for (j, feature) in tqdm(list(enumerate(segments['features'])), desc='Building segments graph'):
-            if feature.type == "Point":
+        segments = json.load(open(file_segments, 'r'))
+        features = [f for f in segments['features'] if f['type'] == 'Feature' and f['geometry'] is not None]
+        coords = [list(geojson.utils.coords(f)) for f in tqdm(features, desc='Filtering road segments')]
+        lengths = np.array([len(c) for c in coords], dtype=np.int64)
+        precision = getattr(geojson.geometry, 'DEFAULT_PRECISION', None) # As applied by geoql.load().
+        xy_list = [[v if precision is None else round(v, precision) for v in p[:2]] for c in coords for p in c]
+        xy = np.array(xy_list, dtype=np.float64).reshape(-1, 2)
+        if tolerance is not None and len(xy) > 0:
+            (xy, lengths) = Grid.snap(xy, lengths, tolerance)
+            (features, lengths) = ([f for (f, n) in zip(features, lengths.tolist()) if n > 0], lengths[lengths > 0])
+            xy_list = xy.tolist()
+        (unique, first, inverse, counts) = np.unique(xy, axis=0, return_index=True, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+
+        # Intersections (in order of first appearance) and the runs of
+        # coordinates between consecutive intersections within a segment.
+        intersections = np.flatnonzero(counts > 1)
+        intersections = intersections[np.argsort(first[intersections], kind='stable')]
+        positions = np.flatnonzero(counts[inverse] > 1)
+        feature_of = np.repeat(np.arange(len(features)), lengths)
+        same = feature_of[positions[:-1]] == feature_of[positions[1:]]
+        (starts, ends) = (positions[:-1][same], positions[1:][same])
+        sizes = ends - starts + 2
+        offsets = np.cumsum(sizes) - sizes
+        k = np.arange(sizes.sum()) - np.repeat(offsets, sizes)
+        run = np.repeat(starts, sizes) + np.minimum(k, np.repeat(ends - starts, sizes))
+
+        run_list = run.tolist()
+        types = [features[i]['geometry']['type'] for i in feature_of[starts].tolist()]
+        output = [{'coordinates': xy_list[i], 'type': 'Point'} for i in first[intersections].tolist()]
+        output.extend(
+            {'geometry': {'coordinates': [xy_list[i] for i in run_list[o:o+n]], 'type': t}, 'properties': {}, 'type': 'Feature'}
+            for (o, n, t) in zip(offsets.tolist(), sizes.tolist(), types)
+          )
+        with open(file_segments_filtered, 'w') as f:
+            json.dump({'features': output, 'type': 'geoql'}, f, sort_keys=True) # The type that geoql writes.
+        if not cache:
+            return
+
+        # Number the nodes as segments_arrays() would on the prepared file:
+        # intersections first, then the remaining coordinates of the runs
+        # (each of which appears exactly once).
+        (node_of, run_unique) = (np.full(len(unique), -1, dtype=np.int64), inverse[run])
+        node_of[intersections] = np.arange(len(intersections))
+        new = counts[run_unique] == 1
+        node_of[run_unique[new]] = len(intersections) + np.arange(np.count_nonzero(new))
+        nodes = np.concatenate([xy[first[intersections]], xy[run[new]]])
+        run_nodes = node_of[run_unique]
+        last = np.zeros(len(run), dtype=bool)
+        last[offsets + sizes - 1] = True
+        edges = np.stack([run_nodes[:-1][~last[:-1]], run_nodes[1:][~last[:-1]]], axis=1)
+        segments_index = len(intersections) + np.arange(len(starts))
+        run_xy = xy[run].reshape(-1, 2)
+        bounds = np.hstack([np.minimum.reduceat(run_xy, offsets), np.maximum.reduceat(run_xy, offsets)]) if len(starts) > 0 else []
+        arrays = Grid.graph_arrays(
+            nodes, np.arange(len(intersections)), np.arange(len(intersections)),
+            edges, np.repeat(segments_index, sizes - 1), segments_index, bounds
+          )
+        path = Grid.cache_path(file_segments_filtered, cache_dir)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.isdir(path):
+            Grid.cache_build(file_segments_filtered, path, arrays)
+
+    @staticmethod
+    def segments_largest_component(segments):
+        '''
+        Filter a GeoJSON collection of road segments (and, optionally,
+        intersection points) down to the largest connected component. Every
+        distinct coordinate is given an integer id and the coordinates of each
+        segment are merged using union-find; the largest component is the one
+        with the most coordinates (ties go to the one appearing first).
+        '''
+        node_ids = {}
+        parent = []
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        features_ids = []
+        for feature in tqdm(segments['features'], desc='Finding connected road segments'):
+            coords = feature['coordinates'] if feature['type'] == 'Point' else feature['geometry']['coordinates']
+            coords = [coords] if feature['type'] == 'Point' else coords
+            ids = [node_ids.setdefault(tuple(c), len(node_ids)) for c in coords]
+            parent.extend(range(len(parent), len(node_ids)))
+            for i in ids[1:]:
+                (r, q) = (find(ids[0]), find(i))
+                if r != q:
+                    parent[max(r, q)] = min(r, q)
+            features_ids.append(ids)
+
+        roots = np.array([find(i) for i in range(len(parent))], dtype=np.int64)
+        if len(roots) == 0:
+            return geojson.FeatureCollection([])
+        sizes = np.bincount(roots, minlength=len(roots))
+        largest = int(np.flatnonzero(sizes == sizes.max())[0]) # Roots are the earliest ids in their components.
+        features = [
+            feature
+            for (feature, ids) in zip(segments['features'], features_ids)
+            if len(ids) > 0 and roots[ids[0]] == largest and (feature['type'] == 'Point' or len(ids) > 1)
+          ]
+        return geojson.FeatureCollection(features)
+
+    @staticmethod
+    def connected_path(file_segments, cache_dir = None):
+        '''
+        Determine the path of the component-filtered copy of a segments file;
+        it is named using the digest of the file so it changes with the
+        contents.
+        '''
+        cache_dir = os.path.join(os.path.dirname(file_segments), '.cache') if cache_dir is None else cache_dir
+        (root, ext) = os.path.splitext(os.path.basename(file_segments))
+        return os.path.join(cache_dir, root + '-connected-' + Grid.digest(file_segments) + ext)
+
+    @staticmethod
+    def connected(file_segments, cache_dir = None):
+        '''
+        Return the path of a copy of a segments file that contains only its
+        largest connected component (which can be loaded in the same way as
+        the original file, e.g., by Grid). The copy is written the first time
+        it is needed and reused until the segments file changes.
+        '''
+        path = Grid.connected_path(file_segments, cache_dir)
+        if not os.path.exists(path):
+            (cache_dir, name) = os.path.split(path)
+            os.makedirs(cache_dir, exist_ok=True)
+            segments = Grid.segments_largest_component(geojson.load(open(file_segments, 'r')))
+            tmp = os.path.join(cache_dir, '.tmp-' + str(os.getpid()) + '-' + name)
+            with open(tmp, 'w') as f:
+                geojson.dump(segments, f, sort_keys=True)
+            os.replace(tmp, path)
+            prefix = name[:-len(name.rsplit('-', 1)[1])]
+            for entry in os.listdir(cache_dir):
+                if entry.startswith(prefix) and entry != name:
+                    os.remove(os.path.join(cache_dir, entry))
+        return path
+
+    @staticmethod
+    def segments_arrays(segments, kernel = 'vincenty'):
+        '''
+        Flatten a GeoJSON graph generated by the geoql function
+        node_edge_graph() into compact arrays: node coordinates (in
+        order of first appearance), intersection nodes, edges with
+        their lengths (computed using the named distance kernel), and
+        the bounding box of every segment.
+        '''
+        node_ids = {}
+        (points, points_index) = ([], [])
+        (edges, edges_index) = ([], [])
+        (segments_index, segments_bounds) = ([], [])
+        for (j, feature) in tqdm(list(enumerate(segments['features'])), desc='Flattening road segments'):
+            if feature.type == 'Point':
                 (lon, lat) = feature.coordinates
-                graph.add_node((lon, lat))
-            elif feature.type == "Feature":
+                points.append(node_ids.setdefault((lon, lat), len(node_ids)))
+                points_index.append(j)
+            elif feature.type == 'Feature':
                 coords = [tuple(c) for c in feature.geometry.coordinates]
-                for i in range(len(coords)-1):
-                    (s, t) = (coords[i], coords[i+1])
-                    graph.add_edge(s, t, index=j, distance=geopy.distance.vincenty(s, t).miles)
+                if len(coords) > 1:
+                    ids = [node_ids.setdefault(c, len(node_ids)) for c in coords]
+                    for i in range(len(coords)-1):
+                        edges.append((ids[i], ids[i+1]))
+                        edges_index.append(j)
+                (lons, lats) = ([c[0] for c in coords], [c[1] for c in coords])
+                segments_index.append(j)
+                segments_bounds.append((min(lons), min(lats), max(lons), max(lats)))
+        nodes = np.array(list(node_ids), dtype=np.float64).reshape(-1, 2)
+        return Grid.graph_arrays(nodes, points, points_index, edges, edges_index, segments_index, segments_bounds, kernel)
+
+    @staticmethod
+    def graph_arrays(nodes, points, points_index, edges, edges_index, segments_index, segments_bounds, kernel = 'vincenty'):
+        '''
+        Assemble the arrays describing a segments graph (as produced by
+        segments_arrays()), computing the edge lengths (using the named
+        distance kernel) and the connected component of every node.
+        '''
+        nodes = np.asarray(nodes, dtype=np.float64).reshape(-1, 2)
+        edges = np.asarray(edges, dtype=np.int32).reshape(-1, 2)
+        edges_distance = distances.miles(nodes[edges[:,0]], nodes[edges[:,1]], kernel)
+
+        # Label every node with its connected component.
+        n = len(nodes)
+        adjacency = scipy.sparse.coo_matrix((np.ones(len(edges)), (edges[:,0], edges[:,1])), shape=(n, n))
+        (_, components) = scipy.sparse.csgraph.connected_components(adjacency, directed=False)
+        return {
+            'nodes': nodes,
+            'points': np.array(points, dtype=np.int32),
+            'points_index': np.array(points_index, dtype=np.int32),
+            'edges': edges,
+            'edges_index': np.array(edges_index, dtype=np.int32),
+            'edges_distance': edges_distance,
+            'segments_index': np.array(segments_index, dtype=np.int32),
+            'segments_bounds': np.array(segments_bounds, dtype=np.float64).reshape(-1, 4),
+            'components': components.astype(np.int32)
+          }
+
+    @staticmethod
+    def arrays_networkx(arrays):
+        '''
+        Build the networkx representation of the segments graph from the
+        arrays produced by segments_arrays(). Nodes and edges are added in
+        their original order, so the result is identical to building the
+        graph directly from the GeoJSON data.
+        '''
+        graph = networkx.Graph()
+        nodes = [tuple(c) for c in arrays['nodes'].tolist()]
+        graph.add_nodes_from(nodes)
+        graph.add_edges_from(
+            (nodes[s], nodes[t], {'index': j, 'distance': d})
+            for ((s, t), j, d) in zip(
+                arrays['edges'].tolist(),
+                arrays['edges_index'].tolist(),
+                arrays['edges_distance'].tolist()
+              )
+          )
         return graph
 
+    @staticmethod
+    def arrays_rtree(arrays, basename = None):
+        '''
+        Build the node and edge R-trees from the arrays produced by
+        segments_arrays(). Entries are keyed by their feature index in
+        the segments data. If a base name is supplied, the trees are
+        stored on disk (and can be reopened later with the same name).
+        '''
+        points = arrays['nodes'][arrays['points']]
+        return (
+            rtree_from_bounds(np.hstack([points, points]), arrays['points_index'], None if basename is None else basename + '-nodes'),
+            rtree_from_bounds(arrays['segments_bounds'], arrays['segments_index'], None if basename is None else basename + '-edges')
+          )
+
+    @staticmethod
+    def segments_networkx(segments):
+        '''
+        Convert a GeoJSON graph generated by the geoql function
+        node_edge_graph() into a networkx representation.
+        '''
+        return Grid.arrays_networkx(Grid.segments_arrays(segments))
+
     @staticmethod
     def segments_rtree(segments):
         '''
         Build an R-tree using the GeoJSON road segments data. Separate
         trees are built for nodes and for edges.
         '''
-        (nodes_rtree, edges_rtree) = (rtree.index.Index(), rtree.index.Index())
-        for i in tqdm(range(len(segments['features'])), desc='Building segments R-tree'):
-            feature = segments['features'][i]
-            if feature.type == 'Point':
-                (lon, lat) = feature.coordinates
-                nodes_rtree.insert(i, (lon, lat, lon, lat))
-            elif feature.type == 'Feature':
-                edges_rtree.insert(i, shapely.geometry.shape(feature['geometry']).bounds)
-        return (nodes_rtree, edges_rtree)
+        return Grid.arrays_rtree(Grid.segments_arrays(segments))
+
+    @staticmethod
+    def digest(file_path):
+        '''
+        Compute a digest of the contents of a file (and of the cache
+        format version) that identifies its cache entry.
+        '''
+        h = hashlib.sha1(('grid-cache-' + str(CACHE_VERSION)).encode())
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    @staticmethod
+    def cache_path(file_path, cache_dir = None):
+        '''
+        Determine the cache directory for a segments file; it is named
+        using the digest of the file so it changes with the contents.
+        '''
+        cache_dir = os.path.join(os.path.dirname(file_path), '.cache') if cache_dir is None else cache_dir
+        return os.path.join(cache_dir, os.path.basename(file_path) + '-' + Grid.digest(file_path))
+
+    @staticmethod
+    def cache_build(file_path, path, arrays = None):
+        '''
+        Build the cache entry for a segments file at the given path (from
+        the arrays for the file if they are supplied). The entry is
+        assembled in a temporary directory and then moved into place, and
+        stale entries for the same file are removed.
+        '''
+        (cache_dir, name) = os.path.split(path)
+        tmp = os.path.join(cache_dir, '.tmp-' + str(os.getpid()) + '-' + name)
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        if arrays is None:
+            arrays = Grid.segments_arrays(geojson.load(open(file_path, 'r')))
+        np.savez(os.path.join(tmp, 'grid.npz'), **arrays)
+        for tree in Grid.arrays_rtree(arrays, os.path.join(tmp, 'rtree')):
+            tree.close()
+        try:
+            os.rename(tmp, path)
+        except OSError: # Another process finished building the same entry first.
+            shutil.rmtree(tmp, ignore_errors=True)
+        prefix = os.path.basename(file_path) + '-'
+        for entry in os.listdir(cache_dir):
+            if entry.startswith(prefix) and entry != name:
+                shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
 
-    def __init__(self, file_path):
-        self.segments = geojson.load(open(file_path, 'r'))
-        self.graph = self.segments_networkx(self.segments)
-        (rtree_nodes, rtree_edges) = self.segments_rtree(self.segments)
-        self.rtree_nodes = rtree_nodes
-        self.rtree_edges = rtree_edges
+    def __init__(self, file_path, cache = True, cache_dir = None, engine = 'networkx', contract = False):
+        '''
+        Load a prepared segments file. Unless caching is disabled, the
+        flattened arrays and R-trees are read from the on-disk cache entry
+        for the file (which is built first if it is missing or stale). The
+        graph is represented using networkx or, if the engine is 'csr', a
+        compact array-backed graph (which produces identical paths). With
+        the 'csr' engine, a contracted graph (in which the chains of shape
+        points between intersections are single edges) can also be built
+        and used for searches by distance between intersections.
+        '''
+        if engine not in ('networkx', 'csr'):
+            raise ValueError("Graph engine must be 'networkx' or 'csr'.")
+        if contract and engine != 'csr':
+            raise ValueError("Graph contraction requires the 'csr' engine.")
+        (self.file_path, self.cache, self.cache_dir) = (file_path, cache, cache_dir)
+        self.engine = engine
+        self._segments = None
+        if cache:
+            path = self.cache_path(file_path, cache_dir)
+            if not os.path.isdir(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                self.cache_build(file_path, path)
+            with np.load(os.path.join(path, 'grid.npz')) as npz:
+                self.arrays = {k: npz[k] for k in npz.files}
+            base = os.path.join(path, 'rtree')
+            (self.rtree_nodes, self.rtree_edges) = (rtree.index.Index(base + '-nodes'), rtree.index.Index(base + '-edges'))
+        else:
+            self._segments = geojson.load(open(file_path, 'r'))
+            self.arrays = self.segments_arrays(self._segments)
+            (self.rtree_nodes, self.rtree_edges) = self.arrays_rtree(self.arrays)
+        self.nodes = self.arrays['nodes']
+        self.node_to_id = {c: i for (i, c) in enumerate(map(tuple, self.nodes.tolist()))}
+        self.components = self.arrays['components']
+        self.point_to_node = dict(zip(self.arrays['points_index'].tolist(), self.arrays['points'].tolist()))
+        self.intersections = np.unique(self.arrays['points'])
+        self.kdtree_intersections = scipy.spatial.cKDTree(self.nodes[self.intersections])
+        if engine == 'csr':
+            self.graph = GraphCSR(self.nodes, self.arrays['edges'], self.arrays['edges_distance'], self.node_to_id)
+        else:
+            self.graph = self.arrays_networkx(self.arrays)
+        self.contracted = ContractedGraph(self.graph, self.intersections) if contract else None
+
+    @property
+    def segments(self):
+        '''
+        The GeoJSON segments data, which is only parsed when it is needed.
+        '''
+        if self._segments is None:
+            self._segments = geojson.load(open(self.file_path, 'r'))
+        return self._segments
+
+    def same_component(self, source, target):
+        '''
+        Determine in constant time (using the precomputed component labels)
+        whether two (lon, lat) nodes are connected.
+        '''
+        (i, j) = (self.node_to_id.get(tuple(source)), self.node_to_id.get(tuple(target)))
+        return i is not None and j is not None and self.components[i] == self.components[j]
+
+    def has_path(self, source, target):
+        '''
+        Determine whether there is a path between two (lon, lat) nodes.
+        '''
+        return self.same_component(source, target)
+
+    def disconnected(self, coords):
+        '''
+        Return the (lon, lat) coordinates in a list that are not nodes of
+        the largest connected component of the graph (the one with the most
+        nodes).
+        '''
+        largest = np.argmax(np.bincount(self.components, minlength=1))
+        return [c for c in coords if self.node_to_id.get(tuple(c)) is None or self.components[self.node_to_id[tuple(c)]] != largest]
+
+    def shortest_path(self, source, target, weight = None):
+        '''
+        Find a path between two (lon, lat) nodes. By default the path has
+        the fewest edges; if the weight is 'distance', the path has the
+        shortest length and is found using A* with a great-circle heuristic
+        (in the contracted graph, if there is one and both nodes are in it).
+        '''
+        if weight not in (None, 'distance'):
+            raise ValueError("Path weight must be None or 'distance'.")
+        if weight is None:
+            if self.engine == 'csr':
+                return self.graph.shortest_path(source, target)
+            return networkx.shortest_path(self.graph, source, target)
+        if self.contracted is not None:
+            (graph, nodes) = (self.contracted.graph, self.contracted.graph.nodes)
+            (i, j) = (graph.node_to_id.get(tuple(source)), graph.node_to_id.get(tuple(target)))
+            if i is not None and j is not None:
+                result = graph.astar_ids(i, j, lambda i, j: great_circle_miles(nodes[i], nodes[j]))
+                return None if result is None else [tuple(c) for c in self.nodes[self.contracted.expand(result[0])].tolist()]
+        if self.engine == 'csr':
+            nodes = self.graph.nodes
+            result = self.graph.astar_ids(
+                self.node_to_id[tuple(source)], self.node_to_id[tuple(target)],
+                lambda i, j: great_circle_miles(nodes[i], nodes[j])
+              )
+            return None if result is None else [tuple(c) for c in nodes[result[0]].tolist()]
+        return networkx.astar_path(self.graph, tuple(source), tuple(target), heuristic=great_circle_miles, weight='distance')
+
+    def path_distance(self, path):
+        '''
+        Length in miles of a path of (lon, lat) nodes, summed from the
+        edge lengths stored in the graph.
+        '''
+        ids = [self.node_to_id[tuple(c)] for c in path]
+        if self.engine == 'csr':
+            return sum(self.graph.edge_weight(ids[i], ids[i+1]) for i in range(len(ids)-1))
+        return sum(self.graph[path[i]][path[i+1]]['distance'] for i in range(len(path)-1))
+
+    def intersection_nearest_many(self, coords):
+        '''
+        Find the nearest intersection to each of an array of (lon, lat)
+        coordinates in a single vectorized query. Returns the node ids of
+        the intersections, their coordinates, and the distances to them
+        (measured in degrees, as with the R-tree).
+        '''
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+        (distances, i) = self.kdtree_intersections.query(coords)
+        indices = self.intersections[i]
+        return (indices, self.nodes[indices], distances)
 
     def intersection_nearest(self, lon_lat):
-        (lon, lat) = lon_lat
-        index = next(self.rtree_nodes.nearest((lon,lat,lon,lat), 1))
-        return self.segments['features'][index].coordinates
+        (indices, coords, distances) = self.intersection_nearest_many([lon_lat])
+        return coords[0].tolist()
 
 if __name__ == "__main__":
     # The following is used to generate the "prepared" road segment data.
     Grid.prepare('input/segments-boston.geojson', 'input/segments-prepared.geojson')
     #open('output/segments.html', 'w').write(geoleaflet.html(Grid('input/segments-prepared.geojson').segments))
 
-## eof
\ No newline at end of file
+## eof
@@ -0,0 +1,235 @@
+"""
+pipeline.py
+
+Module for generating all the data sets by running every stage (the
+individual generate-*.py scripts) in order of their dependencies. Each
+stage is skipped if a fingerprint of its code, input files, and parameters
+matches the one recorded when its (unchanged) outputs were last written,
+and stages that do not depend on each other are run concurrently.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import importlib.util
+import geojson
+import geoleaflet
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import columnar # Module local to this project.
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+DIR_RECORDS = 'output/.pipeline'
+FILE_SEGMENTS = 'input/segments-prepared.geojson'
+MODULES_LOCAL = ['grid.py', 'graph.py', 'distances.py', 'columnar.py', 'streaming.py', 'sheets.py', 'assembled.py']
+
+def module(name):
+    '''
+    Load one of the (hyphenated) generate-*.py scripts as a module. It is
+    registered under a valid module name so that objects defined in it can
+    be pickled (e.g., when routing schools in parallel).
+    '''
+    key = name.replace('-', '_')
+    if key not in sys.modules:
+        spec = importlib.util.spec_from_file_location(key, os.path.join(DIR, name + '.py'))
+        sys.modules[key] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(sys.modules[key])
+    return sys.modules[key]
+
+def grid(engine = 'networkx'):
+    from grid import Grid # Module local to this project.
+    return Grid(FILE_SEGMENTS, engine=engine)
+
+def stage_buses(params):
+    m = module('generate-bus-data')
+    m.xlsx_to_json('input/bps-buses.xlsx', 'output/buses.json')
+    m.buses_locations_move_onto_grid(grid(), 'output/buses.json')
+
+def stage_properties(params):
+    m = module('generate-student-data')
+    m.properties_by_zipcode('input/properties.geojson', 'input/census-blocks.geojson', 'input/properties-by-zipcode.json')
+    m.percentages_csv_to_json('input/student-zip-school-percentages.csv', 'input/student-zip-school-percentages.json')
+
+def stage_students(params):
+    m = module('generate-student-data')
+    students = m.students_simulate(
+        grid(),
+        'input/schools.csv',
+        'input/properties-by-zipcode.json',
+        'input/neighborhood-safety.json',
+        'input/grade-safe-distance.json',
+        'input/student-zip-school-percentages.json',
+        'output/students.geojson',
+        kernel='vincenty', seed=params['seed'], workers=params['workers']
+      )
+    open('output/students.js', 'w').write('var obj = ' + geojson.dumps(students) + ';')
+    m.geojson_to_xlsx('output/students.geojson', 'output/students.xlsx')
+
+def stage_stops(params):
+    m = module('generate-stop-data')
+    m.students_to_stops(grid(), 'output/students.geojson', 'output/stops.json', params['stop_max_dist_miles'], params['max_load'], kernel='vincenty')
+
+def stage_routes(params):
+    m = module('generate-route-data')
+    buses = columnar.read_records('output/buses.json')
+    stops = m.stops_to_dict('output/stops.json')
+    routes = m.school_stops_to_routes(
+        grid('csr'), 'output/students.geojson', m.school_to_stops(stops), buses,
+        max_dist_miles=params['route_max_dist_miles'], max_stops=params['max_stops'], workers=params['workers']
+      )
+    columnar.write_features('output/routes.geojson', [f for r in routes for f in r.features()])
+    open('output/routes.html', 'w').write(geoleaflet.html(geojson.FeatureCollection([f for r in routes for f in r.features()])))
+
+def stage_assembled(params):
+    m = module('generate-assembled-data')
+    m.assemble_xlsx('output/buses.json', 'output/students.geojson', 'output/routes.geojson', 'output/assembled.xlsx')
+
+# For each stage: its function, the script defining it, the parameters it
+# uses, and its input and output files (the inputs written by another
+# stage determine the dependencies between stages).
+STAGES = {
+    'buses': (
+        stage_buses, 'generate-bus-data', [],
+        ['input/bps-buses.xlsx', FILE_SEGMENTS],
+        ['output/buses.json']
+      ),
+    'properties': (
+        stage_properties, 'generate-student-data', [],
+        ['input/properties.geojson', 'input/census-blocks.geojson', 'input/student-zip-school-percentages.csv'],
+        ['input/properties-by-zipcode.json', 'input/student-zip-school-percentages.json']
+      ),
+    'students': (
+        stage_students, 'generate-student-data', ['seed'],
+        [FILE_SEGMENTS, 'input/schools.csv', 'input/properties-by-zipcode.json', 'input/neighborhood-safety.json', 'input/grade-safe-distance.json', 'input/student-zip-school-percentages.json'],
+        ['output/students.geojson', 'output/students.js', 'output/students.xlsx']
+      ),
+    'stops': (
+        stage_stops, 'generate-stop-data', ['stop_max_dist_miles', 'max_load'],
+        [FILE_SEGMENTS, 'output/students.geojson'],
+        ['output/students-stops.columns', 'output/stops.json']
+      ),
+    'routes': (
+        stage_routes, 'generate-route-data', ['route_max_dist_miles', 'max_stops'],
+        [FILE_SEGMENTS, 'output/buses.json', 'output/students.geojson', 'output/students-stops.columns', 'output/stops.json'],
+        ['output/students-buses.columns', 'output/routes.geojson', 'output/routes.html']
+      ),
+    'assembled': (
+        stage_assembled, 'generate-assembled-data', [],
+        ['output/buses.json', 'output/students.geojson', 'output/students-stops.columns', 'output/students-buses.columns', 'output/routes.geojson'],
+        ['output/assembled.xlsx']
+      )
+  }
+
+def dependencies(name):
+    '''
+    Stages that write any of the inputs of a stage.
+    '''
+    inputs = set(STAGES[name][3])
+    return [other for other in STAGES if other != name and inputs & set(STAGES[other][4])]
+
+def fingerprint(name, params):
+    '''
+    Digest of the code, input files, and parameters of a stage.
+    '''
+    (_, script, keys, inputs, _) = STAGES[name]
+    h = hashlib.sha1(json.dumps([name, {k: params[k] for k in keys}], sort_keys=True).encode())
+    for path in [script + '.py'] + MODULES_LOCAL:
+        h.update(columnar.fingerprint(os.path.join(DIR, path)).encode())
+    for path in inputs:
+        h.update((path + ':' + (columnar.fingerprint(path) if os.path.exists(path) else '-')).encode())
+    return h.hexdigest()
+
+def record_path(name):
+    return os.path.join(DIR_RECORDS, name + '.json')
+
+def current(name, params):
+    '''
+    Determine whether the outputs of a stage were written by a run with
+    the same fingerprint and have not changed since (or whether they were
+    supplied directly, in place of some missing inputs).
+    '''
+    if any(not os.path.exists(path) for path in STAGES[name][3]) and all(os.path.exists(path) for path in STAGES[name][4]):
+        print("Stage '" + name + "' is missing some of its inputs; using its existing outputs.")
+        return True
+    if not os.path.exists(record_path(name)):
+        return False
+    record = json.load(open(record_path(name), 'r'))
+    return record['fingerprint'] == fingerprint(name, params) and\
+           all(os.path.exists(path) and columnar.fingerprint(path) == fp for (path, fp) in record['outputs'].items())
+
+def run_stage(name, params):
+    '''
+    Run a stage and record its fingerprint (and those of its outputs).
+    '''
+    fp = fingerprint(name, params)
+    STAGES[name][0](params)
+    missing = [path for path in STAGES[name][4] if not os.path.exists(path)]
+    if len(missing) > 0:
+        raise RuntimeError("Stage '" + name + "' did not write: " + ", ".join(missing) + ".")
+    os.makedirs(DIR_RECORDS, exist_ok=True)
+    outputs = {path: columnar.fingerprint(path) for path in STAGES[name][4]}
+    open(record_path(name), 'w').write(json.dumps({'fingerprint': fp, 'params': params, 'outputs': outputs}, indent=2, sort_keys=True))
+    return name
+
+def run(targets, params, force = False, concurrency = 2):
+    '''
+    Run the target stages and the stages they depend on, in dependency
+    order, skipping those that are current (unless forced). Up to the
+    given number of independent stages are run at once, each in its own
+    process.
+    '''
+    (needed, queue) = (set(), list(targets))
+    while queue:
+        name = queue.pop()
+        if name not in needed:
+            needed.add(name)
+            queue.extend(dependencies(name))
+    order = [name for name in STAGES if name in needed]
+    (done, running) = (set(), {})
+    with ProcessPoolExecutor(max(1, concurrency)) as pool:
+        while len(done) < len(order):
+            for name in order:
+                if name not in done and name not in running.values() and all(d in done for d in dependencies(name) if d in needed):
+                    if not force and current(name, params):
+                        print("Stage '" + name + "' is current; skipping.")
+                        done.add(name)
+                    elif concurrency > 1:
+                        print("Running stage '" + name + "'.")
+                        running[pool.submit(run_stage, name, params)] = name
+                    else:
+                        print("Running stage '" + name + "'.")
+                        done.add(run_stage(name, params))
+            if len(running) > 0:
+                (finished, _) = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done.add(future.result())
+                    del running[future]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate the simulated data sets, skipping stages whose outputs are current.')
+    parser.add_argument('stages', nargs='*', help='stages to run along with their dependencies (default: all): ' + ', '.join(STAGES))
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the student simulation')
+    parser.add_argument('--stop-max-dist-miles', type=float, default=0.3, help='maximum distance between students sharing a stop')
+    parser.add_argument('--max-load', type=int, default=15, help='maximum number of students at a stop')
+    parser.add_argument('--route-max-dist-miles', type=float, default=20, help='maximum length of a route')
+    parser.add_argument('--max-stops', type=int, default=30, help='maximum number of stops on a route')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of processes for simulating students and routing')
+    parser.add_argument('--concurrency', type=int, default=2, help='number of independent stages to run at once')
+    parser.add_argument('--force', action='store_true', help='run stages even if they are current')
+    args = parser.parse_args()
+    for name in args.stages:
+        if name not in STAGES:
+            parser.error("unknown stage '" + name + "'")
+    params = {
+        'seed': args.seed,
+        'stop_max_dist_miles': args.stop_max_dist_miles,
+        'max_load': args.max_load,
+        'route_max_dist_miles': args.route_max_dist_miles,
+        'max_stops': args.max_stops,
+        'workers': args.workers
+      }
+    run(args.stages or list(STAGES), params, force=args.force, concurrency=args.concurrency)
+
+## eof
@@ -1,4 +1,7 @@
 
+import os
+import json
+import hashlib
 from copy import deepcopy
 import geojson
 import geopy.distance
@@ -10,9 +13,12 @@ import rtree
 import pickle
 import numpy as np
 import networkx
-from sklearn.cluster import KMeans
+import scipy.spatial
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from tqdm import tqdm
 
+from grid import Grid # Module local to this project.
+
 # Want a function that takes as input 
 # set of geojson points, set of geojson linestrings
 
@@ -74,29 +80,85 @@ def find_intersection(obj, tree, tree_keys, p, r):
     obj.features = [obj.features[j] for j in result]
     return obj
 
-# UNFINISHED
+def segments_to_arrays(linestrings):
+    '''
+    Flatten a GeoJSON FeatureCollection of LineString entries into arrays
+    of the start and end coordinates of all its (nonzero-length) segments,
+    in order.
+    '''
+    coordinates = [np.asarray(lstr.geometry.coordinates, dtype=np.float64)[:, :2] for lstr in linestrings.features]
+    coordinates = [c for c in coordinates if len(c) > 1]
+    if len(coordinates) == 0:
+        return (np.zeros((0, 2)), np.zeros((0, 2)))
+    starts = np.concatenate([c[:-1] for c in coordinates])
+    ends = np.concatenate([c[1:] for c in coordinates])
+    keep = (starts != ends).any(axis=1)
+    return (starts[keep], ends[keep])
+
+def project_onto_segments(points, starts, ends):
+    '''
+    Compute the projections of points onto segments (all given as arrays
+    of matching or broadcastable shapes) along with the squared distances
+    to those projections.
+    '''
+    d = ends - starts
+    t = np.einsum('...i,...i', points - starts, d) / np.einsum('...i,...i', d, d)
+    t = np.clip(t, 0, 1)[..., None]
+    proj = np.where(t >= 1, ends, starts + t * d)
+    n = proj - points
+    return (proj, np.einsum('...i,...i', n, n))
+
+def nearest_segments(points, starts, ends, k=8):
+    '''
+    Find the nearest segment to each point, along with the projection of the
+    point onto it (ties are broken by segment order). Candidates are found
+    using a k-d tree over the midpoints of pieces of the segments (long
+    segments are split into pieces no longer than a few typical segments):
+    the k nearest pieces bound the distance to the nearest segment, and
+    points for which a nearer segment might have only pieces farther away
+    are resolved with a radius query.
+    '''
+    lengths = np.sqrt(((ends - starts)**2).sum(axis=1))
+    piece = 4 * np.median(lengths)
+    pieces = np.maximum(1, np.ceil(lengths / piece)).astype(np.int64)
+    segment = np.repeat(np.arange(len(starts)), pieces)
+    offset = np.arange(len(segment)) - np.repeat(np.cumsum(pieces) - pieces, pieces)
+    fraction = ((offset + 0.5) / pieces[segment])[:, None]
+    tree = scipy.spatial.cKDTree(starts[segment] + fraction * (ends - starts)[segment])
+    half = (lengths / pieces).max() / 2
+
+    k = min(k, len(segment))
+    (dist_mid, idx) = tree.query(points, k)
+    (dist_mid, idx) = (dist_mid.reshape(len(points), k), segment[idx.reshape(len(points), k)])
+    (proj, dist) = project_onto_segments(points[:, None, :], starts[idx], ends[idx])
+    best = np.lexsort((idx, dist), axis=1)[:, 0]
+    rows = np.arange(len(points))
+    (nearest, proj, dist) = (idx[rows, best], proj[rows, best], dist[rows, best])
+
+    radius = np.sqrt(dist) + half
+    unresolved = np.flatnonzero(dist_mid[:, -1] <= radius) if k < len(segment) else np.zeros(0, dtype=np.int64)
+    if len(unresolved) > 0:
+        candidates = tree.query_ball_point(points[unresolved], radius[unresolved] * (1 + 1e-9))
+        owner = np.repeat(unresolved, [len(c) for c in candidates])
+        idx = segment[np.fromiter((j for c in candidates for j in c), dtype=np.int64, count=len(owner))]
+        (proj_c, dist_c) = project_onto_segments(points[owner], starts[idx], ends[idx])
+        order = np.lexsort((idx, dist_c, owner))
+        first = order[np.r_[True, owner[order][1:] != owner[order][:-1]]]
+        (nearest[owner[first]], proj[owner[first]], dist[owner[first]]) = (idx[first], proj_c[first], dist_c[first])
+    return (nearest, proj)
+
 def project_points_to_linestrings(points, linestrings):
-    # Todo: Implement rtrees to find line points within certain distance.
-    projections = []
-    (tree, tree_keys) = features_to_rtree(linestrings)
-    for (lat, lon) in tqdm(points):
-        p = np.array([lat, lon])
-        lstr_copy = deepcopy(linestrings)
-        lstr_copy = find_intersection(lstr_copy, tree, tree_keys, p, 0.01)
-        lstr_copy = geoql.features_keep_within_radius(lstr_copy, [lon,lat], 0.5, 'miles')
-        min_proj = (10000, [0,0])
-        for lstr in lstr_copy.features:
-            segments = lstr.geometry.coordinates
-            for i in range(len(segments)-1):
-                if np.linalg.norm(np.array(segments[i+1]) - np.array(segments[i])) == 0:
-                    continue
-                norm = normal(p, segments[i], segments[i+1])
-                dist = norm.dot(norm)
-                if dist < min_proj[0]:
-                    proj = project_point_onto_segment(p, segments[i], segments[i+1])
-                    min_proj = [dist, proj, np.array(segments[i]), np.array(segments[i+1])]
-        projections.append(min_proj)
-    return [p[1:] for p in projections]
+    '''
+    Project each of a list of (x, y) points onto the nearest segment of a
+    GeoJSON FeatureCollection of LineString entries, returning a list with
+    the projection and the endpoints of that segment for each point.
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    (starts, ends) = segments_to_arrays(linestrings)
+    if len(points) == 0 or len(starts) == 0:
+        return []
+    (nearest, proj) = nearest_segments(points, starts, ends)
+    return [[proj[i], starts[j], ends[j]] for (i, j) in enumerate(nearest.tolist())]
 
 def load_road_segments(fname):
     linestrings = geojson.loads(open(fname, 'r').read())
@@ -120,14 +182,101 @@ def to_networkx(graph_ql):
 
 def find_connected_segment_indices(obj):
     G = to_networkx(obj)
-    G = nx.subgraph(G, max(nx.connected_components(G), key=lambda x:len(x)))
+    G = networkx.subgraph(G, max(networkx.connected_components(G), key=lambda x:len(x)))
     indices = set()
     for v0, v1 in G.edges():
         indices.add(G[v0][v1]['index'])
     obj.features = [obj.features[i] for i in indices]
     return obj
 
-def generate_student_stops(student_features, numStops=5000, loadFrom=None):
+def cluster_counts(sizes, n_clusters):
+    '''
+    Allocate a number of clusters across partitions in proportion to their
+    sizes (using largest remainders), with at least one cluster and at most
+    one cluster per point in each nonempty partition.
+    '''
+    sizes = np.asarray(sizes, dtype=np.int64)
+    n_clusters = int(min(max(n_clusters, np.count_nonzero(sizes)), sizes.sum()))
+    shares = sizes * n_clusters / max(1, sizes.sum())
+    counts = np.minimum(np.maximum(np.floor(shares).astype(np.int64), (sizes > 0).astype(np.int64)), sizes)
+    order = np.argsort(-(shares - np.floor(shares)), kind='stable').tolist()
+    while counts.sum() < n_clusters:
+        for i in order:
+            if counts.sum() < n_clusters and counts[i] < sizes[i]:
+                counts[i] += 1
+    while counts.sum() > n_clusters:
+        for i in reversed(order):
+            if counts.sum() > n_clusters and counts[i] > 1:
+                counts[i] -= 1
+    return counts
+
+def cluster_points(points, n_clusters, method='full', init=None, random_state=0, batch_size=4096):
+    '''
+    Cluster an array of points with k-means (either 'full' or 'minibatch'),
+    optionally warm-started from an array of initial centroids.
+    '''
+    if init is not None and len(init) != n_clusters: # Pad or trim the warm start.
+        rng = np.random.RandomState(random_state)
+        extra = points[rng.choice(len(points), max(0, n_clusters - len(init)), replace=False)]
+        init = np.concatenate([np.asarray(init, dtype=np.float64).reshape(-1, 2)[:n_clusters], extra])
+    options = {'init': init, 'n_init': 1} if init is not None else {}
+    if method == 'full':
+        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state, **options)
+    elif method == 'minibatch':
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, batch_size=batch_size, **options)
+    else:
+        raise ValueError("Clustering method must be 'full' or 'minibatch'.")
+    k_fit = kmeans.fit(points)
+    return (k_fit.cluster_centers_, k_fit.labels_)
+
+def cluster_stops(points, n_clusters, method='full', partition=None, init=None, random_state=0, batch_size=4096, cache_dir='output/.kmeans'):
+    '''
+    Cluster student locations into stops with k-means. If partition labels
+    (e.g., the ZIP Code or school of each student) are supplied, each
+    partition is clustered separately, with the clusters allocated in
+    proportion to the partition sizes. Previous centroids can be supplied
+    to warm-start the clustering (each is used in the partition of the
+    point nearest to it). Results are cached in files keyed by a digest of
+    the points and all the parameters.
+    '''
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    key = hashlib.sha1(json.dumps([n_clusters, method, random_state, batch_size]).encode())
+    key.update(points.tobytes())
+    if partition is not None:
+        key.update(json.dumps([str(g) for g in partition]).encode())
+    if init is not None:
+        init = np.asarray(init, dtype=np.float64).reshape(-1, 2)
+        key.update(b'init' + init.tobytes())
+    file_cache = None if cache_dir is None else os.path.join(cache_dir, key.hexdigest() + '.npz')
+    if file_cache is not None and os.path.exists(file_cache):
+        cached = np.load(file_cache)
+        return (cached['centers'], cached['labels'])
+
+    if partition is None:
+        (centers, labels) = cluster_points(points, n_clusters, method, init, random_state, batch_size)
+    else:
+        (groups, group_of) = np.unique(np.array([str(g) for g in partition]), return_inverse=True)
+        counts = cluster_counts(np.bincount(group_of, minlength=len(groups)), n_clusters)
+        if init is not None: # Assign each previous centroid to a partition.
+            init_group = group_of[scipy.spatial.cKDTree(points).query(init)[1]]
+        (centers, labels) = ([], np.zeros(len(points), dtype=np.int64))
+        for g in tqdm(range(len(groups)), desc='Clustering partitions'):
+            members = np.flatnonzero(group_of == g)
+            group_init = None if init is None or not (init_group == g).any() else init[init_group == g]
+            if counts[g] == len(members): # Every point is its own cluster.
+                (group_centers, group_labels) = (points[members], np.arange(len(members)))
+            else:
+                (group_centers, group_labels) = cluster_points(points[members], int(counts[g]), method, group_init, random_state, batch_size)
+            labels[members] = group_labels + sum(len(c) for c in centers)
+            centers.append(group_centers)
+        centers = np.concatenate(centers) if len(centers) > 0 else np.zeros((0, 2))
+
+    if file_cache is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(file_cache, centers=centers, labels=labels)
+    return (centers, labels)
+
+def generate_student_stops(student_features, numStops=5000, loadFrom=None, method='full', partition=None, warmStart=None):
     # We assume that the order of stops will not change at any point.
     # We don't want to do anything to d2d stops.
     #d2d_stops = [f['geometry']['coordinates'][0]
@@ -145,20 +294,25 @@ def generate_student_stops(student_features, numStops=5000, loadFrom=None):
         corner_stops = k_fit['corner_stops']
         labels = k_fit['labels']
     else:
-        # Generate means for corner students.
-        kmeans = KMeans(n_clusters=numStops-len(d2d_stops), random_state=0)
-        k_fit = kmeans.fit(corner_students)
-        corner_stops = k_fit.cluster_centers_
-        labels = k_fit.labels_
+        # Generate means for corner students (partitioned by a property
+        # such as 'zip' or 'school' if one is named, and warm-started from
+        # the stops of a previous run if a file is named).
+        groups = None if partition is None else [
+            feature['properties'][partition]
+            for feature in student_features['features']
+            if feature['properties']['pickup'] == 'corner'
+          ]
+        init = None if warmStart is None else pickle.load(open(warmStart, 'rb'))['corner_stops']
+        (corner_stops, labels) = cluster_stops(corner_students, numStops-len(d2d_stops), method, groups, init)
 
         # Write kmeans results to a file.
         with open('output/kmeans', 'wb') as f:
             f.write(pickle.dumps({'corner_stops': corner_stops, 'labels': labels}))
         print('K-means output written.', flush=True)
 
-    # Get LineString entries from road segment data.
-    linestrings = load_road_segments('input/road-network-extract-missing.geojson')
-    linestrings = find_connected_segment_indices(linestrings)
+    # Get LineString entries from road segment data (filtered to the largest
+    # connected component once, and cached).
+    linestrings = load_road_segments(Grid.connected('input/road-network-extract-missing.geojson'))
     projected_corner_stops = project_points_to_linestrings(corner_stops, linestrings)
     return list(d2d_stops), list(projected_corner_stops)
 
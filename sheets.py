@@ -0,0 +1,104 @@
+"""
+sheets.py
+
+Module containing utilities for exporting data sets as XLSX worksheets
+quickly and with bounded memory use.
+"""
+
+import csv
+import pickle
+import itertools
+import xlsxwriter
+from tqdm import tqdm
+
+def workbook(file_xlsx):
+    '''
+    Create a workbook in constant memory mode, in which each row is written
+    to disk once the next row is started (so rows must be written in order
+    and each worksheet must be completed before the next one is started).
+    '''
+    return xlsxwriter.Workbook(file_xlsx, {'constant_memory': True})
+
+def chunks(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def item_columns(columns, items):
+    '''
+    Compute each of a list of (header, function) columns for all items,
+    as a list of column arrays.
+    '''
+    return [list(map(function, items)) for (header, function) in columns]
+
+def write_rows(xl_sheet, rows, start = 1):
+    for (row, values) in enumerate(rows, start):
+        xl_sheet.write_row(row, 0, values)
+    return start + len(rows)
+
+def write_sheet(xl_workbook, xl_bold, name, columns, items, desc = None, chunk_size = 10000):
+    '''
+    Add a worksheet with a bold header row and a row for every item (which
+    may be a stream, e.g., of features) given a list of (header, function)
+    columns. Items are processed in chunks: the column arrays of a chunk
+    are computed first, and then each row is written whole.
+    '''
+    xl_sheet = xl_workbook.add_worksheet(name)
+    xl_sheet.write_row(0, 0, [header for (header, function) in columns], xl_bold)
+    row = 1
+    with tqdm(desc=desc, unit=' rows', disable=desc is None) as progress:
+        for chunk in chunks(items, chunk_size):
+            row = write_rows(xl_sheet, list(zip(*item_columns(columns, chunk))), row)
+            progress.update(len(chunk))
+    return xl_sheet
+
+def spool_rows(file_spool, columns, items, chunk_size = 10000):
+    '''
+    Compute the rows for all items (which may be a stream) given a list of
+    (header, function) columns, and write them to a spool file in chunks
+    (each pickled separately), so that they can be passed to another
+    process without holding them all in memory.
+    '''
+    with open(file_spool, 'wb') as f:
+        for chunk in chunks(items, chunk_size):
+            pickle.dump(list(zip(*item_columns(columns, chunk))), f, pickle.HIGHEST_PROTOCOL)
+    return file_spool
+
+def write_sheet_spooled(xl_workbook, xl_bold, name, headers, file_spool):
+    '''
+    Add a worksheet given its headers and a spool file of its rows (as
+    written by spool_rows()), reading and writing one chunk at a time.
+    '''
+    xl_sheet = xl_workbook.add_worksheet(name)
+    xl_sheet.write_row(0, 0, headers, xl_bold)
+    row = 1
+    with open(file_spool, 'rb') as f:
+        while True:
+            try:
+                rows = pickle.load(f)
+            except EOFError:
+                break
+            row = write_rows(xl_sheet, rows, row)
+    return xl_sheet
+
+def write_part(file_part, name, columns, items):
+    '''
+    Write a sheet on its own, as a CSV file or (otherwise) as a workbook
+    containing only that sheet, depending on the file extension.
+    '''
+    if file_part.endswith('.csv'):
+        with open(file_part, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow([header for (header, function) in columns])
+            for chunk in chunks(items, 10000):
+                writer.writerows(zip(*item_columns(columns, chunk)))
+    else:
+        xl_workbook = workbook(file_part)
+        write_sheet(xl_workbook, xl_workbook.add_format({'bold': True}), name, columns, items)
+        xl_workbook.close()
+    return file_part
+
+## eof
@@ -0,0 +1,173 @@
+"""
+streaming.py
+
+Module containing utilities for reading and writing large JSON/GeoJSON
+files incrementally, so that memory use is bounded by the size of one
+entry (or one group of entries) rather than by the size of the file.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import ijson
+import geojson
+
+def iter_items(file_path, prefix):
+    '''
+    Iterate over the JSON values found under a prefix (in ijson notation,
+    e.g., 'features.item') of a file without loading the whole file.
+    Numbers are parsed exactly as json.load() parses them.
+    '''
+    with open(file_path, 'rb') as f:
+        for item in ijson.items(f, prefix, use_float=True):
+            yield item
+
+def iter_key_values(file_path, prefix = ''):
+    '''
+    Iterate over the (key, value) pairs of the JSON object found under a
+    prefix (by default, the top-level object) of a file.
+    '''
+    with open(file_path, 'rb') as f:
+        for (key, value) in ijson.kvitems(f, prefix, use_float=True):
+            yield (key, value)
+
+def iter_features(file_path):
+    '''
+    Iterate over the features of a GeoJSON FeatureCollection file.
+    '''
+    return iter_items(file_path, 'features.item')
+
+class GroupedJSONWriter():
+    '''
+    Writer for a JSON file containing an object that maps group names to
+    objects, e.g., {zip: {id: property, ...}, ...}, whose entries arrive in
+    any order. Entries are spooled to one temporary file per group, and on
+    closing the output is written one group at a time. The output is the
+    same as json.dumps(groups, indent=2, sort_keys=True).
+    '''
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.dir = tempfile.mkdtemp(prefix='.spool-', dir=os.path.dirname(os.path.abspath(file_path)))
+        self.files = {}
+
+    def add(self, group, key, value):
+        if group not in self.files:
+            self.files[group] = open(os.path.join(self.dir, str(len(self.files))), 'w')
+        self.files[group].write(json.dumps([key, value]) + '\n')
+
+    def close(self):
+        try:
+            for f in self.files.values():
+                f.close()
+            with open(self.file_path, 'w') as out:
+                out.write('{')
+                for (k, group) in enumerate(sorted(self.files)):
+                    with open(self.files[group].name, 'r') as f:
+                        entries = dict(json.loads(line) for line in f)
+                    # Reuse the standard formatting, minus the enclosing braces.
+                    out.write((',\n' if k > 0 else '\n') + json.dumps({group: entries}, indent=2, sort_keys=True)[2:-2])
+                out.write('\n}' if len(self.files) > 0 else '}')
+        finally:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class FeatureCollectionWriter():
+    '''
+    Writer for a GeoJSON FeatureCollection file whose features are written
+    in chunks as they are produced (or as parts that were encoded
+    elsewhere, e.g., by worker processes). The output is the same as
+    geojson.dumps(geojson.FeatureCollection(features), indent=indent).
+    '''
+    def __init__(self, file_path, indent = None, chunk_size = 1000):
+        self.file = open(file_path, 'w')
+        self.indent = indent
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.count = 0
+        self.file.write('{"type": "FeatureCollection", "features": [' if indent is None else\
+                        '{\n' + ' ' * indent + '"type": "FeatureCollection",\n' + ' ' * indent + '"features": [')
+
+    @staticmethod
+    def separator(indent):
+        return ', ' if indent is None else ',\n'
+
+    @staticmethod
+    def encode(features, indent = None):
+        '''
+        Encode a list of features as they appear (joined by separators)
+        within the list of features of a collection.
+        '''
+        text = geojson.dumps(features, indent=indent)[1:-1]
+        if indent is None:
+            return text
+        # Strip the newlines around the list and nest it one level deeper.
+        prefix = ' ' * indent
+        return prefix + text[1:-1].replace('\n', '\n' + prefix)
+
+    def _append(self, text, count):
+        if count > 0:
+            self.file.write(self.separator(self.indent) if self.count > 0 else ('' if self.indent is None else '\n'))
+            self.file.write(text)
+            self.count += count
+
+    def flush(self):
+        self._append(self.encode(self.chunk, self.indent), len(self.chunk))
+        self.chunk = []
+
+    def write(self, feature):
+        self.chunk.append(feature)
+        if len(self.chunk) >= self.chunk_size:
+            self.flush()
+
+    def write_part(self, file_part, count):
+        '''
+        Append a number of features encoded (using write_features()) in
+        another file, which is then removed.
+        '''
+        self.flush()
+        if count > 0:
+            self._append('', count)
+            with open(file_part, 'r') as f:
+                shutil.copyfileobj(f, self.file)
+        os.remove(file_part)
+
+    @staticmethod
+    def write_features(file_part, features, indent = None, chunk_size = 1000):
+        '''
+        Encode features into a file that can be appended using write_part(),
+        returning the number of features.
+        '''
+        (count, chunk) = (0, [])
+        with open(file_part, 'w') as f:
+            def flush():
+                f.write((FeatureCollectionWriter.separator(indent) if count > 0 else '') + FeatureCollectionWriter.encode(chunk, indent))
+                return (count + len(chunk), [])
+            for feature in features:
+                chunk.append(feature)
+                if len(chunk) >= chunk_size:
+                    (count, chunk) = flush()
+            if len(chunk) > 0:
+                (count, chunk) = flush()
+        return count
+
+    def close(self):
+        self.flush()
+        if self.indent is None:
+            self.file.write(']}')
+        else:
+            self.file.write(('\n' + ' ' * self.indent + ']' if self.count > 0 else ']') + '\n}')
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+## eof